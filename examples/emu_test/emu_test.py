@@ -1,9 +1,11 @@
 import sys
 sys.path.insert(1, '../../src/')
-from emulator.emulator import emulatedHw
+from emulator.emulator import emulatedHw, stackedEmulatedHw, shardedEmulatedHw, traceRecord, traceArchive, KERNEL_CACHE
+from firmware.compiler import analyze, compiler, FIRMWARE_CACHE
 from hardware.hardware import rtlHw
+from misc.misc import encode, decode
 import firmware.firmware as firm
-import math, yaml
+import math, yaml, io, os, tempfile
 import numpy as np
 
 # Read YAML configuration file and declare those as global variables
@@ -176,4 +178,473 @@ def testVectorChange():
 
     print("Passed test #6")
 
-testVectorChange()
\ No newline at end of file
+testVectorChange()
+
+def testFastEngine():
+
+    # Instantiate one processor for each engine
+    procs = [emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,ENGINE=engine) for engine in ['cycle','fast']]
+
+    # Feed the same values to both processors
+    np.random.seed(0)
+    input_vectors=np.random.rand(IB_DEPTH,N)*8-2
+    eof=[False,True,False,False,True,False,True,True]
+    for proc in procs:
+        proc.fu.vrf=list(range(FUVRF_SIZE*M))
+        proc.config(firm.distribution(proc.compiler,bins=2*M,M=M))
+        for v, e in zip(input_vectors,eof):
+            proc.push([v,e])
+
+    # Step through it until we get the result
+    cycle_log = procs[0].run()
+    fast_log = procs[1].run()
+    assert np.array_equal(cycle_log['tb'][-1],fast_log['tb'][-1]), "Fast engine does not match cycle engine"
+
+    # Chains that pass values to each other through the cache and the minicache
+    for firmware in [firm.correlation,firm.vectorChange,firm.activationPredictiveness,firm.minicache]:
+        procs = [emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,ENGINE=engine) for engine in ['cycle','fast']]
+        for proc in procs:
+            proc.config(firmware(proc.compiler))
+            for v, e in zip(input_vectors,eof):
+                proc.push([v,e,not e])
+            proc.run(steps=None)
+        assert np.array_equal(procs[0].tb.mem,procs[1].tb.mem) and np.array_equal(procs[0].vvalu.vrf,procs[1].vvalu.vrf), "Fast engine does not match cycle engine for "+firmware.__name__
+    print("Passed test #7")
+
+testFastEngine()
+
+def testProbes():
+
+    # Instantiate processor
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    proc.fu.vrf=list(range(FUVRF_SIZE*M))
+    proc.config(firm.distribution(proc.compiler,bins=2*M,M=M))
+
+    # Keep the last 4 outputs of the ALU and the chain dispatched every other cycle
+    proc.probe(['vvalu','vvalu.chainId_out'],depth=4)
+    proc.probe(['ib.chainId_out'],decimation=2)
+
+    np.random.seed(0)
+    proc.push([np.random.rand(N)*8,True])
+    log = proc.run(steps=20)
+    assert log['vvalu'].shape==(4,N), "Probe depth not respected"
+    assert np.array_equal(log.cycles('vvalu'),[16,17,18,19]), "Probe ring buffer out of order"
+    assert np.array_equal(log['vvalu'][-1],proc.vvalu.v_out), "Probe recorded wrong values"
+    assert np.array_equal(log.cycles('ib.chainId_out'),range(0,20,2)), "Probe decimation not respected"
+
+    # Nothing is recorded once recording is turned off
+    log.enabled=False
+    proc.run(steps=20)
+    assert np.array_equal(log.cycles('vvalu'),[16,17,18,19]), "Probe recorded while disabled"
+    print("Passed test #8")
+
+testProbes()
+
+def testPushMany():
+
+    # Frames of 4 vectors, more than fit in the input buffer
+    np.random.seed(0)
+    T = 4*IB_DEPTH
+    input_vectors=np.random.rand(T,N)*8-2
+    eof=np.arange(T)%4==3
+
+    # Push the same vectors one by one, as a tensor and from a generator
+    results = []
+    for engine, vectors in [['cycle',input_vectors],['cycle',(v for v in input_vectors)],['fast',input_vectors]]:
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,ENGINE=engine)
+        proc.fu.vrf=list(range(FUVRF_SIZE*M))
+        proc.config(firm.distribution(proc.compiler,bins=2*M,M=M))
+        proc.push_many(vectors,eof)
+        results.append(proc.run(steps=T*MAX_CHAINS)['tb'][-1])
+    assert np.array_equal(results[0],results[1]), "Pushing vectors from a generator failed"
+    assert np.array_equal(results[0],results[2]), "Pushing vectors with the fast engine failed"
+
+    # Vectors that do not fit are dropped and counted
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    proc.config(firm.distribution(proc.compiler,bins=2*M,M=M))
+    assert proc.push_many(input_vectors,eof,backpressure='drop')==T-IB_DEPTH-1, "Dropped vectors not counted"
+    print("Passed test #9")
+
+testPushMany()
+
+def testRunUntilDrained():
+
+    # Instantiate one processor for each engine
+    procs = [emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,ENGINE=engine) for engine in ['cycle','fast']]
+    np.random.seed(0)
+    input_vectors=np.random.rand(IB_DEPTH,N)*8-2
+    for proc in procs:
+        proc.fu.vrf=list(range(FUVRF_SIZE*M))
+        proc.config(firm.summaryStats(proc.compiler))
+        proc.push_many(input_vectors,np.arange(IB_DEPTH)%4==3)
+
+    # Both engines report the cycles needed to dispatch every chain and flush the pipeline
+    cycles = [proc.run(steps=None) for proc in procs]
+    num_chains = procs[0].ib.config.num_chains-1
+    assert cycles[0]==cycles[1]==IB_DEPTH*num_chains+procs[0].PIPELINE_DEPTH, "Wrong number of cycles"
+    assert np.array_equal(procs[0].tb.mem,procs[1].tb.mem), "Trace buffer not flushed"
+
+    # Idle cycles are skipped without changing the results
+    procs[0].run(steps=1000000)
+    assert procs[0].cycle==cycles[0]+1000000 and np.array_equal(procs[0].tb.mem,procs[1].tb.mem)
+    print("Passed test #10")
+
+testRunUntilDrained()
+
+def testStackedInstances():
+
+    # Each instance gets its own stream of vectors, with a different number of vectors
+    K = 3
+    np.random.seed(0)
+    streams = [np.random.rand(T,N)*8-2 for T in [IB_DEPTH,IB_DEPTH//2,1]]
+    eofs = [np.arange(len(v))%3==2 for v in streams]
+
+    stacked = stackedEmulatedHw(K,N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    stacked.fu.vrf=list(range(FUVRF_SIZE*M))
+    stacked.config(firm.summaryStats(stacked.compiler))
+    for k in range(K):
+        stacked.push_many(k,streams[k],eofs[k])
+    stacked_tb = stacked.run(steps=IB_DEPTH*MAX_CHAINS)['tb'][-1]
+
+    # Results of each instance match the ones of a single emulator
+    for k in range(K):
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+        proc.fu.vrf=list(range(FUVRF_SIZE*M))
+        proc.config(firm.summaryStats(proc.compiler))
+        proc.push_many(streams[k],eofs[k])
+        assert np.array_equal(proc.run(steps=IB_DEPTH*MAX_CHAINS)['tb'][-1],stacked_tb[k]), "Stacked instance "+str(k)+" failed"
+
+    # Trace buffers of stacked instances cannot be streamed
+    try:
+        stacked.stream('trace.bin')
+        assert False, "Stacked instances streamed their trace buffers"
+    except AssertionError as e:
+        assert "cannot stream" in str(e), str(e)
+    print("Passed test #11")
+
+testStackedInstances()
+
+def testShardedEmulation():
+
+    # Independent streams are emulated in parallel
+    np.random.seed(0)
+    streams = [np.random.rand(T,N)*8-2 for T in [4*IB_DEPTH,IB_DEPTH,3]]
+    sharded = shardedEmulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,WORKERS=2)
+    sharded.initialize_fu(list(range(FUVRF_SIZE*M)))
+    sharded.config(firm.distribution(sharded.compiler,bins=2*M,M=M))
+    for v in streams:
+        sharded.push_many(v,np.arange(len(v))%4==3)
+    sharded_tb = sharded.run()
+
+    # Results of each shard match the ones of a single emulator
+    for s, v in enumerate(streams):
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+        proc.fu.vrf=list(range(FUVRF_SIZE*M))
+        proc.config(firm.distribution(proc.compiler,bins=2*M,M=M))
+        proc.push_many(v,np.arange(len(v))%4==3)
+        proc.run(steps=None)
+        assert proc.cycle==sharded.cycles[s] and np.array_equal(proc.tb.mem,sharded_tb[s]), "Shard "+str(s)+" failed"
+
+    # Splitting a stream into epochs produces the same trace as emulating it as a whole
+    v = np.concatenate(streams[:2])
+    eof1, eof2 = np.arange(len(v))%4==3, np.arange(len(v))%8==7
+    sharded.push_epochs(v,eof1,eof2)
+    sharded.run()
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    proc.fu.vrf=list(range(FUVRF_SIZE*M))
+    proc.config(firm.distribution(proc.compiler,bins=2*M,M=M))
+    proc.push_many(v,eof1,eof2)
+    proc.run(steps=None)
+    assert np.array_equal(sharded.trace(),proc.tb.mem[:proc.tb.size]), "Sharding epochs failed"
+    print("Passed test #12")
+
+testShardedEmulation()
+
+def testBitAccurate():
+
+    # Fixed-point results match the floating point ones up to the precision of the fixed-point format
+    np.random.seed(0)
+    input_vectors=np.random.rand(IB_DEPTH,N)*8
+    results = []
+    for data_type in ['float','fixed_point']:
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE=data_type,DATA_WIDTH=32)
+        proc.config(firm.correlation(proc.compiler))
+        proc.push_many(input_vectors)
+        proc.run(steps=None)
+        results.append(proc.arith.decode(proc.tb.mem))
+    assert np.allclose(results[0],results[1],atol=0.01), "Fixed-point emulation failed"
+
+    # Integers wrap around like in the hardware
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE='int',DATA_WIDTH=8)
+    proc.config(firm.vvalu_simple(proc.compiler))
+    proc.push_many(np.full((2,N),200))
+    proc.run(steps=None)
+    assert np.array_equal(proc.tb.mem[:2],[N*[200],N*[144]]), "Integer wraparound failed"
+
+    # Stacked instances compute with the same words
+    stacked = stackedEmulatedHw(2,N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE='fixed_point',DATA_WIDTH=16)
+    stacked.fu.vrf=list(range(FUVRF_SIZE*M))
+    stacked.config(firm.distribution(stacked.compiler,bins=2*M,M=M))
+    eof = np.arange(IB_DEPTH)%4==3
+    stacked.push_many(0,input_vectors,eof)
+    stacked.push_many(1,input_vectors[::-1],eof)
+    stacked.run(steps=None)
+    assert stacked.tb.size[0]>0 and np.any(stacked.tb.mem[0]!=stacked.tb.mem[1])
+    for k, vectors in enumerate([input_vectors,input_vectors[::-1]]):
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE='fixed_point',DATA_WIDTH=16)
+        proc.fu.vrf=list(range(FUVRF_SIZE*M))
+        proc.config(firm.distribution(proc.compiler,bins=2*M,M=M))
+        proc.push_many(vectors,eof)
+        proc.run(steps=None)
+        assert np.array_equal(proc.tb.mem,stacked.tb.mem[k]), "Bit-accurate stacked instance "+str(k)+" failed"
+    print("Passed test #13")
+
+testBitAccurate()
+
+def testEncoding():
+
+    # Values are rounded, saturated and stored in two's complement
+    values = np.array([[1.5,-1.5],[1e9,-1e9]])
+    words = encode(values,32)
+    assert np.array_equal(words,[[98304,4294868992],[2147483647,2147483649]]), "Encoding failed"
+    assert encode(-1.5,32)==4294868992, "Encoding a scalar failed"
+
+    # Words can be decoded in place
+    decoded = decode(words,32,out=words.view(np.float64))
+    assert np.shares_memory(decoded,words) and np.allclose(decoded,[[1.5,-1.5],[32768,-32768]],atol=1e-4), "Decoding failed"
+    print("Passed test #14")
+
+testEncoding()
+
+def testHalfPrecision():
+
+    # Histograms committed in half precision take half of the trace buffer
+    np.random.seed(0)
+    input_vectors=np.random.rand(4*IB_DEPTH,N)*8
+    for data_type in ['float','int','fixed_point']:
+        results = []
+        for precision in ['full','half']:
+            proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE=data_type)
+            proc.fu.vrf=list(range(FUVRF_SIZE*M))
+            proc.config(firm.distribution(proc.compiler,bins=2*M,M=M,precision=precision))
+            proc.push_many(input_vectors,np.arange(4*IB_DEPTH)%4==3)
+            proc.run(steps=None)
+            results.append(proc.tb.mem[:proc.tb.size])
+        assert 2*len(results[1])==len(results[0]), "Half precision values not packed"
+        assert np.array_equal(proc.arith.decode(results[0]).reshape(-1),proc.arith.unpack(results[1]).reshape(-1)), "Half precision failed with "+data_type
+    print("Passed test #15")
+
+testHalfPrecision()
+
+def testTraceSink():
+
+    # Words that no longer fit in the trace buffer are still handed to the sink
+    np.random.seed(0)
+    input_vectors=np.random.rand(8*TB_SIZE,N)*8
+    results = {}
+    for engine in ['cycle','fast']:
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,ENGINE=engine)
+        proc.fu.vrf=list(range(FUVRF_SIZE*M))
+        proc.config(firm.distribution(proc.compiler,bins=2*M,M=M))
+        file = io.BytesIO()
+        proc.stream(file)
+        proc.push_many(input_vectors,np.ones(len(input_vectors),dtype=bool))
+        proc.run(steps=None)
+        results[engine] = np.frombuffer(file.getvalue(),dtype=traceRecord(N))
+    records = results['cycle']
+    assert len(records)==proc.tb.count and len(records)>TB_SIZE, "Trace sink missed words"
+    assert np.array_equal(records['seq'],np.arange(len(records))) and np.all(np.diff(records['cycle'].astype(int))>0), "Wrong sequence numbers"
+    assert np.array_equal(records['word'][records['seq']%TB_SIZE==TB_SIZE-1][-1],proc.tb.mem[-1]), "Trace sink does not match the trace buffer"
+    assert np.array_equal(records,results['fast']), "Trace sink differs between engines"
+    print("Passed test #16")
+
+testTraceSink()
+
+def testTraceArchive():
+
+    # Histograms of each epoch are read back from the archive without going through the whole trace
+    np.random.seed(0)
+    input_vectors=np.random.rand(16*TB_SIZE,N)*8
+    eof1=np.arange(len(input_vectors))%4==3
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,ENGINE='fast')
+    proc.fu.vrf=list(range(FUVRF_SIZE*M))
+    proc.config(firm.distribution(proc.compiler,bins=2*M,M=M))
+    with tempfile.TemporaryDirectory() as folder:
+        archive = traceArchive(os.path.join(folder,'trace'),N)
+        proc.stream(archive)
+        proc.push_many(input_vectors,eof1)
+        proc.run(steps=None)
+        proc.stream(None)
+        epoch = 4*TB_SIZE-1
+        histogram = np.stack([np.histogram(v,bins=np.arange(2*M+1))[0] for v in input_vectors[4*epoch:4*epoch+4]]).sum(axis=0)
+        records = archive.epoch(epoch)
+        assert len(records)==1 and np.array_equal(records['word'][0],histogram), "Wrong epoch read from trace archive"
+        assert archive.length==proc.tb.count==len(archive.records()), "Trace archive missed words"
+        archive.close()
+    print("Passed test #17")
+
+testTraceArchive()
+
+def testAnalyzer():
+
+    # Static analysis matches what the emulator does
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,ENGINE='fast')
+    proc.fu.vrf=list(range(FUVRF_SIZE*M))
+    fw = firm.distribution(proc.compiler,bins=2*M,M=M)
+    report = analyze(fw,N,IB_DEPTH,TB_SIZE,BUILDING_BLOCKS,vectors_per_epoch=4)
+    input_vectors=np.random.rand(4*TB_SIZE,N)*8
+    proc.config(fw)
+    proc.push_many(input_vectors,np.arange(4*TB_SIZE)%4==3)
+    proc.run(steps=None)
+    assert report.cycles_per_vector==2 and report.pipeline_depth==proc.PIPELINE_DEPTH, "Wrong cycles per vector"
+    assert proc.cycle==len(input_vectors)*report.cycles_per_vector+report.pipeline_depth, "Wrong number of cycles"
+    assert proc.tb.count==TB_SIZE*report.words_per_epoch, "Wrong number of trace buffer words"
+
+    # The input buffer takes max_burst back-to-back vectors before it overflows
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    proc.config(fw)
+    for i in range(report.max_burst):
+        proc.push([input_vectors[i],False])
+        proc.step()
+    assert proc.push_many(input_vectors[:1],backpressure='drop')==1, "Input buffer did not overflow"
+    print("Passed test #18")
+
+testAnalyzer()
+
+def testOptimizer():
+
+    # A chain that only caches the vector and a chain that only commits it are merged, and a chain without effects is removed
+    def firmware(cp,optimize):
+        cp.begin_chain()
+        cp.v_cache(0)
+        cp.end_chain()
+        cp.begin_chain()
+        cp.vv_add(0)
+        cp.end_chain()
+        cp.begin_chain()
+        cp.v_commit()
+        cp.end_chain()
+        return cp.compile(optimize)
+
+    np.random.seed(0)
+    input_vectors=np.random.rand(IB_DEPTH,N)*8
+    results = []
+    for optimize in [False,True]:
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+        fw = firmware(proc.compiler,optimize)
+        proc.config(fw)
+        proc.push_many(input_vectors)
+        cycles = proc.run(steps=None)
+        results.append(proc.tb.mem)
+    assert fw['valid_chains']==1 and fw['saved_cycles']==2, "Chains were not merged"
+    assert cycles==len(input_vectors)+proc.PIPELINE_DEPTH, "Wrong number of cycles"
+    assert np.array_equal(results[0],results[1]), "Optimized firmware gives different results"
+
+    # Firmware is only optimized when asked to
+    assert firm.passThrough(compiler(N,M,MAX_CHAINS))['valid_chains']==1, "Firmware was optimized by default"
+    assert firm.passThrough(compiler(N,M,MAX_CHAINS,OPTIMIZE=True))['valid_chains']==0, "Compiler did not optimize firmware"
+    print("Passed test #19")
+
+testOptimizer()
+
+def testAllocation():
+
+    # Named buffers get addresses from the compiler. Buffers only used while a vector goes through the chains share addresses.
+    def firmware(cp):
+        for name in ['sum','max']:
+            cp.begin_chain()
+            cp.v_cache(name+'_copy')
+            cp.end_chain()
+            cp.begin_chain()
+            cp.vv_sub(name+'_copy')
+            cp.v_commit(N,'last')
+            cp.end_chain()
+            cp.begin_chain()
+            cp.vv_add(name,'notfirst') if name=='sum' else cp.vv_max(name,'notfirst')
+            cp.v_cache(name)
+            cp.v_commit(N,'last')
+            cp.end_chain()
+        return cp.compile()
+
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    fw = firmware(proc.compiler)
+    assert len(set(fw['addresses']['vvalu'].values()))==3, "Named buffers were not allocated"
+    np.random.seed(0)
+    input_vectors=np.random.rand(4,N)*8
+    proc.config(fw)
+    proc.push_many(input_vectors,[False,False,False,True])
+    proc.run(steps=None)
+    expected = [np.zeros(N),input_vectors.sum(axis=0),np.zeros(N),input_vectors.max(axis=0)]
+    assert np.allclose(proc.tb.mem[:4],expected), "Allocated buffers overlap"
+
+    # A buffer written again after another buffer was allocated stays live until its last write
+    def clobber(cp,a,b):
+        cp.begin_chain()
+        cp.v_cache(a)
+        cp.end_chain()
+        cp.begin_chain()
+        cp.vv_sub(a)
+        cp.v_commit(N)
+        cp.end_chain()
+        cp.begin_chain()
+        cp.v_cache(b)
+        cp.end_chain()
+        cp.begin_chain()
+        cp.vv_mul(VVVRF_SIZE-1)
+        cp.v_cache(a)
+        cp.end_chain()
+        cp.begin_chain()
+        cp.vv_sub(b)
+        cp.v_commit(N)
+        cp.end_chain()
+        return cp.compile()
+    for a, b in [('A','B'),(0,1)]:
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+        proc.config(clobber(proc.compiler,a,b))
+        proc.push_many(input_vectors[:2])
+        proc.run(steps=None)
+        assert np.allclose(proc.tb.mem[:4],0), "Named buffer was overwritten while live"
+
+    # Firmware that does not fit in the VRFs is rejected
+    try:
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,2,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+        firmware(proc.compiler)
+        assert False, "VVVRF capacity was not checked"
+    except AssertionError as e:
+        assert "VVVRF addresses" in str(e), str(e)
+    print("Passed test #20")
+
+testAllocation()
+
+def testMemoizedFirmware():
+
+    # Compiling the same firmware again on a new compiler reuses the chains, which cannot be modified
+    fw1 = firm.distribution(compiler(N,M,MAX_CHAINS),bins=2*M,M=M)
+    fw2 = firm.distribution(compiler(N,M,MAX_CHAINS),bins=2*M,M=M)
+    assert fw1 is not fw2 and fw1['fu'] is not fw2['fu'] and fw1['fu'][0] is fw2['fu'][0], "Firmware was not memoized"
+    assert np.array_equal(fw1['table'],fw2['table']) and fw1['valid_chains']==2, "Memoized firmware differs"
+    assert fw1['fu'][-1] is fw1['fu'][-2], "Empty chains are not shared"
+    try:
+        fw1['fu'][0].addr = 1
+        assert False, "Chains can be modified"
+    except AttributeError:
+        pass
+
+    # Only the most recently used firmware is kept
+    for max_chains in range(1,FIRMWARE_CACHE.maxsize+2):
+        firm.passThrough(compiler(N,M,max_chains))
+    assert len(FIRMWARE_CACHE)==FIRMWARE_CACHE.maxsize, "Firmware cache is not bounded"
+    assert firm.distribution(compiler(N,M,MAX_CHAINS),bins=2*M,M=M)['fu'][0] is not fw1['fu'][0], "Evicted firmware was reused"
+
+    # Kernels specialized for each firmware are bounded the same way
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    for i in range(KERNEL_CACHE.maxsize+1):
+        cp = compiler(N,M,MAX_CHAINS)
+        cp.begin_chain()
+        getattr(cp,['vv_add','vv_mul','vv_sub','vv_max'][i%4])(i//4%VVVRF_SIZE,[None,'last','first','notlast','notfirst'][i//(4*VVVRF_SIZE)])
+        cp.end_chain()
+        proc.config(cp.compile())
+    assert len(KERNEL_CACHE)==KERNEL_CACHE.maxsize, "Kernel cache is not bounded"
+    print("Passed test #21")
+
+testMemoizedFirmware()
@@ -9,12 +9,10 @@ import numpy as np
 np.set_printoptions(precision=3, suppress=False)
 
 # Filter results after computations
+# The emulator is bit-accurate, so both trace buffers hold the same encoded words
 def filterResults(emu_results, hw_results, DATA_TYPE):
-    emu_results_filtered = emu_results['tb'][-1];
-    if DATA_TYPE=='int':
-        hw_results_filtered = np.array(toInt(hw_results['tb']['mem_data']))
-    elif DATA_TYPE=='fixed_point':
-        hw_results_filtered = np.array(encodedIntTofloat(hw_results['tb']['mem_data'],DATA_WIDTH))
+    emu_results_filtered = emu_results['tb'][-1].astype(int)
+    hw_results_filtered = np.array(toInt(hw_results['tb']['mem_data']))
 
     # Print Results
     print("\n\n********** Emulation results **********")
@@ -61,7 +59,7 @@ def raw():
     # Instantiate HW and Emulator Processors
     readConf()
     hw_proc  = rtlHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,DATA_WIDTH,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE,DEVICE_FAM)
-    emu_proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    emu_proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE=DATA_TYPE,DATA_WIDTH=DATA_WIDTH)
 
     # Create common input values
     num_input_vectors=3
@@ -81,7 +79,7 @@ def raw():
     emu_results_filtered, hw_results_filtered = filterResults(emu_results, hw_results, DATA_TYPE)
 
     # Verify that results are equal
-    assert np.allclose(emu_results_filtered,hw_results_filtered,rtol=0.01)
+    assert np.array_equal(emu_results_filtered,hw_results_filtered)
     print("Passed test #1")
 
 raw()
@@ -91,7 +89,7 @@ def multipleChains():
     # Instantiate HW and Emulator Processors
     readConf()
     hw_proc  = rtlHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,DATA_WIDTH,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE,DEVICE_FAM)
-    emu_proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    emu_proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE=DATA_TYPE,DATA_WIDTH=DATA_WIDTH)
 
     # Create common input values
     num_input_vectors=1
@@ -115,7 +113,7 @@ def multipleChains():
     emu_results_filtered, hw_results_filtered = filterResults(emu_results, hw_results, DATA_TYPE)
 
     # Verify that results are equal
-    assert np.allclose(emu_results_filtered,hw_results_filtered, rtol=0.01)
+    assert np.array_equal(emu_results_filtered,hw_results_filtered)
     print("Passed test #2")
 
 multipleChains()
@@ -126,7 +124,7 @@ def correlation():
     readConf()
     TB_SIZE=10
     hw_proc  = rtlHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,DATA_WIDTH,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE,DEVICE_FAM)
-    emu_proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    emu_proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE=DATA_TYPE,DATA_WIDTH=DATA_WIDTH)
 
     # Create common input values
     num_input_vectors=5
@@ -146,7 +144,7 @@ def correlation():
     emu_results_filtered, hw_results_filtered = filterResults(emu_results, hw_results, DATA_TYPE)
 
     # Verify that results are equal
-    assert np.allclose(emu_results_filtered,hw_results_filtered, rtol=0.05)
+    assert np.array_equal(emu_results_filtered,hw_results_filtered)
     print("Passed test #3")
 
 correlation()
@@ -157,7 +155,7 @@ def conditions():
     # Instantiate HW and Emulator Processors
     readConf()
     hw_proc  = rtlHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,DATA_WIDTH,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE,DEVICE_FAM)
-    emu_proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    emu_proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE=DATA_TYPE,DATA_WIDTH=DATA_WIDTH)
 
     # Create common input values
     num_input_vectors=5
@@ -178,7 +176,7 @@ def conditions():
     emu_results_filtered, hw_results_filtered = filterResults(emu_results, hw_results, DATA_TYPE)
 
     # Verify that results are equal
-    assert np.allclose(emu_results_filtered,hw_results_filtered, rtol=0.05)
+    assert np.array_equal(emu_results_filtered,hw_results_filtered)
     print("Passed test #4")
 
 conditions()
@@ -189,7 +187,7 @@ def distribution():
     # Instantiate HW and Emulator Processors
     readConf()
     hw_proc  = rtlHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,DATA_WIDTH,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE,DEVICE_FAM)
-    emu_proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    emu_proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE=DATA_TYPE,DATA_WIDTH=DATA_WIDTH)
 
     # Create common input values
     num_input_vectors=2
@@ -214,7 +212,7 @@ def distribution():
     emu_results_filtered, hw_results_filtered = filterResults(emu_results, hw_results, DATA_TYPE)
 
     # Verify that results are equal
-    assert np.allclose(emu_results_filtered,hw_results_filtered)
+    assert np.array_equal(emu_results_filtered,hw_results_filtered)
     print("Passed test #5")
 
 distribution()
@@ -226,7 +224,7 @@ def minicache_test():
     readConf()
     DATA_TYPE='int'
     hw_proc  = rtlHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,DATA_WIDTH,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE,DEVICE_FAM)
-    emu_proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    emu_proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE=DATA_TYPE,DATA_WIDTH=DATA_WIDTH)
 
     # Create common input values
     num_input_vectors=3
@@ -247,7 +245,7 @@ def minicache_test():
     emu_results_filtered, hw_results_filtered = filterResults(emu_results, hw_results, DATA_TYPE)
 
     # Verify that results are equal
-    assert np.allclose(emu_results_filtered,hw_results_filtered,rtol=0.05)
+    assert np.array_equal(emu_results_filtered,hw_results_filtered)
     print("Passed test #6")
 
 minicache_test()
@@ -260,7 +258,7 @@ def predictiveness():
     DATA_TYPE='int'
     BUILDING_BLOCKS=['InputBuffer', 'FilterReduceUnit','VectorScalarReduce','VectorVectorALU','DataPacker','TraceBuffer']
     hw_proc  = rtlHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,DATA_WIDTH,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE,DEVICE_FAM)
-    emu_proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS) 
+    emu_proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE=DATA_TYPE,DATA_WIDTH=DATA_WIDTH) 
 
     # Create common input values
     num_input_vectors=4
@@ -282,7 +280,38 @@ def predictiveness():
     emu_results_filtered, hw_results_filtered = filterResults(emu_results, hw_results, DATA_TYPE)
 
     # Verify that results are equal
-    assert np.allclose(emu_results_filtered,hw_results_filtered,rtol=0.05)
+    assert np.array_equal(emu_results_filtered,hw_results_filtered)
     print("Passed test #7")
 
-predictiveness()
\ No newline at end of file
+predictiveness()
+
+def halfPrecision():
+
+    # Instantiate HW and Emulator Processors
+    readConf()
+    hw_proc  = rtlHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,DATA_WIDTH,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE,DEVICE_FAM)
+    emu_proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE=DATA_TYPE,DATA_WIDTH=DATA_WIDTH)
+
+    # Create common input values
+    num_input_vectors=2
+    eof1=num_input_vectors*[True]
+    pushVals(emu_proc,hw_proc,num_input_vectors,eof1)
+
+    # Configure firmware - Both HW and Emulator work with the same firmware
+    fw = firm.distribution(hw_proc.compiler,16,4,precision='half')
+    emu_proc.config(fw)
+    hw_proc.config(fw)
+
+    # Run HW simulation and emulation
+    steps=45
+    hw_results = hw_proc.run(steps=steps,gui=False,log=False)
+    emu_results = emu_proc.run(steps=steps)
+
+    # Filter Results
+    emu_results_filtered, hw_results_filtered = filterResults(emu_results, hw_results, DATA_TYPE)
+
+    # Verify that results are equal
+    assert np.array_equal(emu_results_filtered,hw_results_filtered)
+    print("Passed test #8")
+
+halfPrecision()
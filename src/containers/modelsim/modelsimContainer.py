@@ -1,4 +1,4 @@
-import docker, subprocess, sys, shlex
+import docker, subprocess, sys, shlex, os, io, tarfile, hashlib
 
 class modelsimContainer():
 
@@ -73,3 +73,110 @@ class modelsimContainer():
             self.container = self.dockerClient.containers.get('modelsim')
             print("Download complete")
 
+
+# Keeps the modelsim container running across simulations, so that many simulations can be run on the same warm container
+# Files are only copied to the container if they changed since they were last synced
+class modelsimSession(modelsimContainer):
+
+    # Folder of the container where compiled vendor libraries are kept
+    LIBRARY_FOLDER='/lebug/libraries'
+
+    # Start the container (if it is not running yet) and create the working folder
+    def start(self):
+        if not self.running:
+            self.container.reload()
+            if self.container.status!='running':
+                self.container.start()
+            self.exec(f'mkdir -p {self.folder}')
+            self.running=True
+
+    # Remove the working folder and stop the container
+    def stop(self):
+        if self.running:
+            self.exec(f'rm -r {self.folder}')
+            super().stop()
+            self.running=False
+            self.synced={}
+            self.libraries=set()
+
+    # Copy the files of a local folder that changed since the last sync to the working folder (in a single archive)
+    def sync(self,local_folder):
+        changed={}
+        for root, _, files in os.walk(local_folder):
+            for name in files:
+                path=os.path.join(root,name)
+                with open(path,'rb') as f:
+                    digest=hashlib.sha1(f.read()).hexdigest()
+                if self.synced.get(os.path.relpath(path,local_folder))!=digest:
+                    changed[os.path.relpath(path,local_folder)]=(path,digest)
+        if len(changed)>0:
+            archive=io.BytesIO()
+            with tarfile.open(fileobj=archive,mode='w') as tar:
+                for name, (path, digest) in changed.items():
+                    tar.add(path,arcname=name)
+            self.container.put_archive(self.folder,archive.getvalue())
+            self.synced.update({name: digest for name, (path, digest) in changed.items()})
+        return list(changed.keys())
+
+    # Copy files from the working folder to a local folder
+    def fetch(self,names,local_folder):
+        for name in names:
+            stream, _ = self.container.get_archive(f'{self.folder}/{name}')
+            with tarfile.open(fileobj=io.BytesIO(b''.join(stream))) as tar:
+                tar.extractall(local_folder)
+
+    # Create a library in the working folder unless it was already created in this session
+    def library(self,name='work'):
+        if name not in self.libraries:
+            self.exec(f'vlib {name}',working_directory=self.folder)
+            self.libraries.add(name)
+
+    # Run a command in the container and return its exit code and output
+    def check(self,cmd,working_directory="/"):
+        exit_code, output = self.container.exec_run(shlex.split(cmd),workdir=working_directory)
+        return exit_code, output.decode("utf-8")
+
+    # Compile the vendor simulation models of a local folder into a library that is kept in the container across sessions
+    # Libraries are named after a hash of the models, the device family and the simulator version, so they are compiled once for each of them
+    def vendorLibrary(self,models_folder,models,device_family):
+        if self.simulator_version is None:
+            self.simulator_version=self.check('vsim -version')[1]
+        key=(models_folder,tuple(models),device_family)
+        if key not in self.vendor_libraries:
+            digest=hashlib.sha1((device_family+self.simulator_version).encode())
+            for name in models:
+                with open(os.path.join(models_folder,name),'rb') as f:
+                    digest.update(name.encode()+f.read())
+            path=f'{self.LIBRARY_FOLDER}/{digest.hexdigest()}'
+            if self.check(f'test -d {path}/vendor')[0]!=0:
+                if self.log:
+                    print(f"Compiling vendor simulation models for {device_family} into {path}")
+                self.exec(f'mkdir -p {path}')
+                archive=io.BytesIO()
+                with tarfile.open(fileobj=archive,mode='w') as tar:
+                    for name in models:
+                        tar.add(os.path.join(models_folder,name),arcname=name)
+                self.container.put_archive(path,archive.getvalue())
+                # The library is compiled under a temporary name, so that a failed compilation is not reused
+                self.exec(f'vlib {path}/compiling',working_directory=path)
+                exit_code, output = self.check(f'vlog -work {path}/compiling '+' '.join(models),working_directory=path)
+                assert exit_code==0, f"Failed to compile vendor simulation models:\n{output}"
+                self.exec(f'mv {path}/compiling {path}/vendor')
+            self.vendor_libraries[key]=f'{path}/vendor'
+        return self.vendor_libraries[key]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,*args):
+        self.stop()
+
+    def __init__(self,log=True,folder='/rtl'):
+        super().__init__(log)
+        self.folder=folder
+        self.running=False
+        self.synced={}          # Digest of each file of the working folder
+        self.libraries=set()
+        self.vendor_libraries={}    # Path of the compiled vendor library of each set of models
+        self.simulator_version=None
@@ -1,7 +1,9 @@
 import logging as log
-import sys, math
+import sys, os, math, inspect, itertools, multiprocessing
 import numpy as np
-from firmware.compiler import compiler
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from firmware.compiler import compiler, FIRMWARE_TABLE, BLOCK_LATENCY, batchCondition
 from misc.misc import *
 
 # Setting Debug level (can be debug, info, warning, error and critical)
@@ -10,43 +12,408 @@ log.basicConfig(stream=sys.stderr, level=log.INFO)
 ''' Emulation settings '''
 DEBUG=True
 
+# Vector-vector ALU ops, indexed by the opcode used in the firmware
+VVALU_OPS={1:np.add, 2:np.multiply, 3:np.subtract, 4:np.maximum}
+
+# Maximum number of M*N filter results kept in memory when processing a batch of vectors
+BATCH_ELEMENTS=1<<22
+
+# End of frame flags (eof1, eof2) indexed by the code stored in the input buffer (eof1 + 2*eof2)
+EOF_FLAGS=[(False,False),(True,False),(False,True),(True,True)]
+EOF_BITS=np.array(EOF_FLAGS,dtype=bool)
+
+# Kernels specialized for a given firmware, keyed by the emulator, the firmware table and the order of the building blocks
+# Like compiled firmware, only the kernels of the most recently loaded firmware are kept
+KERNEL_CACHE=lruCache(64)
+
+# Group vectors and their eof flags coming from iterables into arrays of up to "size" vectors
+def chunks(vectors,eof1,eof2,size):
+    items = zip(vectors,
+                itertools.repeat(False) if eof1 is None else eof1,
+                itertools.repeat(False) if eof2 is None else eof2)
+    while True:
+        chunk = list(itertools.islice(items,size))
+        if len(chunk)==0:
+            return
+        v, e1, e2 = zip(*chunk)
+        yield np.array(v,dtype=float), np.array(e1,dtype=bool), np.array(e2,dtype=bool)
+
+# Conditions are bitmasks of the conditions that must hold (see CONDITION_BITS in the compiler)
+# A condition is met if all of its bits are set in the status of the vector
+def conditionMet(cond,eof,bof):
+    if cond==0:
+        return True
+    status = (1 if eof[0] else 2) | (4 if bof[0] else 8) | (16 if eof[1] else 32) | (64 if bof[1] else 128)
+    return (cond & ~status)==0
+
+# Arithmetic of the values going through the emulator. By default, values are floats
+class floatArith():
+    dtype=float
+    # Value of each range that a vector falls into in the filter unit
+    ONE=1
+    ALU=VVALU_OPS
+
+    def encode(self,values):
+        return np.asarray(values,dtype=float)
+
+    def decode(self,words):
+        return np.asarray(words,dtype=float)
+
+    # Values committed in half precision are rounded to float16 and packed in pairs into 32-bit words
+    def pack(self,values):
+        return packHalf(np.asarray(values,dtype=np.float16).view(np.uint16),32).astype(self.dtype)
+
+    # Decode words packed in half precision
+    def unpack(self,words):
+        return unpackHalf(words,32).astype(np.uint16).view(np.float16).astype(float)
+
+    def sum(self,x,axis=None,out=None):
+        return np.sum(x,axis=axis,out=out)
+
+    # Sum of n values equal to ONE, like the reduction of n ranges of the filter unit
+    def count(self,n):
+        return (n*self.ONE).astype(self.dtype)
+
+    # Ops that can be accumulated over time by the vector-vector ALU
+    def accumulates(self,op):
+        return op in [1,2,4]
+
+    def accumulate(self,op,x):
+        self.ALU[op].accumulate(x,axis=0,out=x)
+
+    # Upper edge of the last range of each address. The last range ends where the next address starts
+    # If there is no next address, extrapolate
+    def lastEdges(self,vrf,M):
+        num_addr = len(vrf)//M
+        last = np.arange(num_addr)*M+M-1
+        edges = vrf[np.minimum(last+1,len(vrf)-1)]
+        if num_addr>0 and last[-1]+1>=len(vrf):
+            edges[-1] = vrf[last[-1]]+(vrf[last[-1]]-vrf[last[-1]-1])
+        return edges
+
+# Bit-accurate arithmetic of DATA_WIDTH-bit integers, with the same encoding and wraparound as the hardware
+# Words are stored as unsigned integers, like the registers of the hardware
+class intArith():
+
+    def __init__(self,DATA_WIDTH):
+        assert 1<DATA_WIDTH<=32, "Bit-accurate emulation supports data widths of up to 32 bits"
+        self.DATA_WIDTH=DATA_WIDTH
+        self.MASK=(1<<DATA_WIDTH)-1
+        self.SIGN=1<<(DATA_WIDTH-1)
+        self.HALF_MASK=(1<<(DATA_WIDTH//2))-1
+        self.dtype=np.uint32
+        self.ONE=1
+        self.ALU={1:self.add,2:self.multiply,3:self.subtract,4:self.maximum}
+
+    # Values that are not integers are rounded, and infinities are saturated
+    def encode(self,values):
+        x = np.asarray(values)
+        if x.dtype.kind=='f':
+            x = np.clip(np.round(x),-self.SIGN,self.MASK)
+        return (x.astype(np.int64) & self.MASK).astype(self.dtype)
+
+    def decode(self,words):
+        return np.asarray(words).astype(np.int64)
+
+    # Values committed in half precision keep their lower DATA_WIDTH/2 bits, and are packed in pairs into words
+    def half(self,values):
+        return np.asarray(values).astype(np.uint64) & np.uint64(self.HALF_MASK)
+
+    def pack(self,values):
+        return packHalf(self.half(values),self.DATA_WIDTH).astype(self.dtype)
+
+    # Decode words packed in half precision
+    def unpack(self,words):
+        return unpackHalf(words,self.DATA_WIDTH).astype(np.int64)
+
+    # Operations on uint32 already wrap around at 32 bits, so narrower words only need to be truncated
+    def wrap(self,x):
+        if self.DATA_WIDTH==32:
+            return x
+        if isinstance(x,np.ndarray):
+            return np.bitwise_and(x,self.MASK,out=x)
+        return x & self.MASK
+
+    # Two's complement value of the words
+    def signed(self,x):
+        x = np.asarray(x).astype(np.int64)
+        return (x ^ self.SIGN)-self.SIGN
+
+    # Write a result computed with wider integers as words
+    def store(self,x,out):
+        x = x & self.MASK
+        if out is None:
+            return x.astype(self.dtype)
+        np.copyto(out,x,casting='unsafe')
+        return out
+
+    def add(self,a,b,out=None):
+        return self.wrap(np.add(a,b,out=out))
+
+    def subtract(self,a,b,out=None):
+        return self.wrap(np.subtract(a,b,out=out))
+
+    def multiply(self,a,b,out=None):
+        return self.wrap(np.multiply(a,b,out=out))
+
+    # Integers are compared as unsigned values
+    def maximum(self,a,b,out=None):
+        return np.maximum(a,b,out=out)
+
+    def sum(self,x,axis=None,out=None):
+        return self.wrap(np.sum(x,axis=axis,dtype=self.dtype,out=out))
+
+    def count(self,n):
+        return self.wrap((n*self.ONE).astype(self.dtype))
+
+    def accumulates(self,op):
+        return op in [1,2,4]
+
+    def accumulate(self,op,x):
+        {1:np.add,2:np.multiply,4:np.maximum}[op].accumulate(x,axis=0,out=x)
+        self.wrap(x)
+
+    # The upper edge of the last range is extrapolated from the first two edges of the same address
+    def lastEdges(self,vrf,M):
+        ops = vrf[:len(vrf)//M*M].reshape(-1,M).astype(np.int64)
+        if M==1:
+            return (ops[:,0]+1) & self.MASK
+        return (ops[:,M-1]+ops[:,1]-ops[:,0]) & self.MASK
+
+# Bit-accurate fixed point arithmetic, with DATA_WIDTH/2 fractional bits
+class fixedPointArith(intArith):
+
+    def __init__(self,DATA_WIDTH):
+        super().__init__(DATA_WIDTH)
+        self.FRAC_BITS=DATA_WIDTH//2
+        # Reductions of the filter unit count in fixed point
+        self.ONE=1<<self.FRAC_BITS
+
+    # Values are rounded and saturated like the inputs of the hardware
+    def encode(self,values):
+        return (encode(values,self.DATA_WIDTH) & self.MASK).astype(self.dtype)
+
+    def decode(self,words):
+        return decode(words,self.DATA_WIDTH)
+
+    # Half precision values are fixed point with DATA_WIDTH/4 fractional bits
+    def half(self,values):
+        return (np.asarray(values).astype(np.uint64) >> np.uint64(self.DATA_WIDTH//4)) & np.uint64(self.HALF_MASK)
+
+    def unpack(self,words):
+        return decode(unpackHalf(words,self.DATA_WIDTH),self.DATA_WIDTH//2)
+
+    # Products are computed with 2*DATA_WIDTH bits and then shifted back
+    def multiply(self,a,b,out=None):
+        return self.store((self.signed(a)*self.signed(b))>>self.FRAC_BITS,out)
+
+    # Fixed point values are compared as signed values
+    def maximum(self,a,b,out=None):
+        return self.store(np.where(self.signed(a)>self.signed(b),a,b),out)
+
+    def accumulates(self,op):
+        return op in [1,4]
+
+    def accumulate(self,op,x):
+        if op==4:
+            x[:] = np.maximum.accumulate(self.signed(x),axis=0) & self.MASK
+        else:
+            super().accumulate(op,x)
+
+# Arithmetic used for a given DATA_TYPE ('float', 'int' or 'fixed_point')
+def arithmetic(DATA_TYPE,DATA_WIDTH):
+    assert DATA_TYPE in ['float','int','fixed_point'], "DATA_TYPE must be 'float', 'int' or 'fixed_point'"
+    if DATA_TYPE=='float':
+        return floatArith()
+    return {'int':intArith,'fixed_point':fixedPointArith}[DATA_TYPE](DATA_WIDTH)
+
+# Records signals of the building blocks into preallocated arrays
+# Signals are named after a block ('vvalu') to record its output, or after one of its fields ('vvalu.v_out_d1')
+class probeRecorder():
+    OUTPUTS={'ib':'v_out','fu':'m_out','mvru':'v_out','vsru':'v_out','vvalu':'v_out','dp':'v_out','tb':'mem'}
+
+    def __init__(self,blocks):
+        self.blocks=blocks
+        self.probes=[]
+        self.enabled=True
+
+    # Record signals every "decimation" cycles, keeping only the last "depth" samples if a depth is given
+    # If decimation is None, signals are recorded once at the end of every run
+    def probe(self,signals,depth=None,decimation=1):
+        assert depth is None or depth>0, "Probe depth must be positive"
+        assert decimation is None or decimation>0, "Probe decimation must be positive"
+        capacity = 1024 if depth is None else depth
+        p=struct(signals={},depth=depth,decimation=decimation,count=0,cycles=np.zeros(capacity,dtype=int))
+        for name in signals:
+            block, _, field = name.partition('.')
+            assert block in self.blocks, "Unknown block "+block
+            field = field if field else self.OUTPUTS[block]
+            value = np.asarray(getattr(self.blocks[block],field))
+            p.signals[name]=struct(block=self.blocks[block],field=field,data=np.zeros((capacity,)+value.shape,dtype=value.dtype))
+        self.probes.append(p)
+
+    # Check if any signal needs to be recorded on every cycle (as opposed to at the end of a run)
+    def everyCycle(self):
+        return self.enabled and any(p.decimation is not None for p in self.probes)
+
+    # Stop recording all signals
+    def clear(self):
+        self.probes=[]
+
+    def record(self,cycle,end_of_run=False):
+        if not self.enabled:
+            return
+        for p in self.probes:
+            if p.decimation is None:
+                if end_of_run:
+                    self.sample(p,cycle)
+            elif not end_of_run and cycle%p.decimation==0:
+                self.sample(p,cycle)
+
+    def sample(self,p,cycle):
+        # Unbounded probes double their capacity when they are full
+        if p.depth is None and p.count==len(p.cycles):
+            p.cycles=np.concatenate((p.cycles,np.zeros_like(p.cycles)))
+            for sig in p.signals.values():
+                sig.data=np.concatenate((sig.data,np.zeros_like(sig.data)))
+        idx = p.count % len(p.cycles)
+        p.cycles[idx]=cycle
+        for sig in p.signals.values():
+            sig.data[idx]=getattr(sig.block,sig.field)
+        p.count+=1
+
+    # Samples are returned from oldest to newest
+    def order(self,p,data):
+        if p.count<=len(p.cycles):
+            return data[:p.count]
+        idx = p.count % len(p.cycles)
+        return np.concatenate((data[idx:],data[:idx]))
+
+    def find(self,name):
+        for p in self.probes:
+            if name in p.signals:
+                return p
+        assert False, "Signal "+name+" is not being probed"
+
+    def __getitem__(self,name):
+        p=self.find(name)
+        return self.order(p,p.signals[name].data)
+
+    # Cycles in which each sample of a signal was recorded
+    def cycles(self,name):
+        p=self.find(name)
+        return self.order(p,p.cycles)
+
+# Hands every word committed to the trace buffer to a sink as soon as it is produced
+# The sink can be a function called as sink(seq,cycle,word), a generator that is sent (seq,cycle,word) tuples,
+# a file (or the name of a file) to which traceRecord(N,dtype) records are appended, or a traceArchive
+class traceSink():
+    def __init__(self,target,N,dtype):
+        self.record=traceRecord(N,dtype)
+        self.owned=isinstance(target,(str,os.PathLike))
+        if self.owned:
+            target=open(target,'ab')
+        if isinstance(target,traceArchive):
+            assert target.record==self.record, "The trace archive must have the same N and dtype as the trace buffer"
+            self.kind='archive'
+        elif hasattr(target,'write'):
+            self.kind='file'
+        elif hasattr(target,'send'):
+            self.kind='generator'
+            # Generators need to reach their first yield before they can receive values
+            if inspect.getgeneratorstate(target)==inspect.GEN_CREATED:
+                next(target)
+        else:
+            assert callable(target), "Trace sinks must be functions, generators or files"
+            self.kind='function'
+        self.target=target
+
+    # Words have consecutive sequence numbers starting at seq
+    # Each word also has the (epoch1,epoch2,chain) of the value that completed it, which is only kept by archives
+    def write(self,seq,cycles,words,keys):
+        if self.kind=='archive':
+            self.target.append(seq,cycles,words,keys)
+            return
+        if self.kind=='file':
+            records=np.empty(len(words),dtype=self.record)
+            records['seq']=seq+np.arange(len(words))
+            records['cycle']=cycles
+            records['word']=words
+            self.target.write(records.tobytes())
+            return
+        for i, word in enumerate(words):
+            # Words are copied, since the data packer keeps reusing its output register
+            record=(seq+i,int(cycles[i]),np.array(word))
+            if self.kind=='generator':
+                self.target.send(record)
+            else:
+                self.target(*record)
+
+    def close(self):
+        if self.owned:
+            self.target.close()
+        elif self.kind in ['file','archive']:
+            self.target.flush()
+
 class emulatedHw():
 
     # Input buffer class 
     class InputBuffer():
-        def __init__(self,N,IB_DEPTH):
-            self.buffer=[]
+        def __init__(self,N,IB_DEPTH,arith):
             self.N = N
+            self.arith = arith
             self.size=IB_DEPTH
+            # Vectors are kept in a circular buffer. One extra entry holds the vector being dispatched
+            self.capacity=IB_DEPTH+1
+            self.v=np.zeros((self.capacity,N),dtype=arith.dtype)
+            self.eof=np.zeros(self.capacity,dtype=np.uint8)
+            self.head=0
+            self.count=0
+            self.dropped=0
             self.config=None
             self.chainId_out = 0
-            self.bof_out=[True,True]
+            self.bof_out=(True,True)
+            self.v_idle=np.zeros(N,dtype=arith.dtype)
+            self.v_out=self.v_idle
+            self.eof_out=EOF_FLAGS[0]
 
         def push(self,pushed_vals):
-            eof_in = [False,False]
-            if len(pushed_vals)==2:
-                pushed_vals.append(False)
-            v_in, eof_in[0], eof_in[1] = pushed_vals
+            v_in, eof1, eof2 = (list(pushed_vals)+[False])[:3]
             assert list(v_in.shape)==[self.N], "Input must be Nx1"
-            assert len(self.buffer)<=self.size, "Input buffer overflowed"
-            log.debug('Vector inserted into input buffer\n'+str(v_in))
-            self.buffer.append([v_in,eof_in])
+            assert self.count<self.capacity, "Input buffer overflowed"
+            log.debug('Vector inserted into input buffer')
+            tail=(self.head+self.count)%self.capacity
+            self.v[tail]=self.arith.encode(v_in)
+            self.eof[tail]=bool(eof1)+2*bool(eof2)
+            self.count+=1
+
+        # Push as many vectors of a TxN array as fit in the buffer, returning how many were pushed
+        def push_many(self,v_in,eof1,eof2):
+            assert v_in.ndim==2 and v_in.shape[1]==self.N, "Input must be TxN"
+            T=min(len(v_in),self.capacity-self.count)
+            tail=(self.head+self.count+np.arange(T))%self.capacity
+            self.v[tail]=self.arith.encode(v_in[:T])
+            self.eof[tail]=eof1[:T]+2*eof2[:T]
+            self.count+=T
+            return T
 
         def pop(self):
             log.debug("Removing element from input buffer")
-            assert len(self.buffer)>0, "Input buffer is empty"
-            self.bof_out=self.buffer[0][1]
-            return self.buffer.pop(0)
+            assert self.count>0, "Input buffer is empty"
+            v_out, self.bof_out = self.v[self.head], EOF_FLAGS[self.eof[self.head]]
+            self.head=(self.head+1)%self.capacity
+            self.count-=1
+            return v_out, self.bof_out
 
         def step(self):
             # Dispatch a new chain if the input buffer is not empty
             # Note that if our FW has 3 chains num_chains will be 4, since we need one "chain" (chainId 0) to work as a pass through
-            if len(self.buffer)>0:
+            if self.count>0:
                 if self.chainId_out<self.config.num_chains:
                     # Go to next element in the input buffer once we dispatched all chains for the previous element
                     if self.chainId_out==self.config.num_chains-1:
                         self.pop()
-                        self.chainId_out = 0 if len(self.buffer)==0 else 1 
+                        self.chainId_out = 0 if self.count==0 else min(1,self.config.num_chains-1)
                     else:
                         self.chainId_out=self.chainId_out+1
 
@@ -54,57 +421,130 @@ class emulatedHw():
             else:
                 self.chainId_out=0
 
-            if len(self.buffer)>0:
-                v_out, eof_out = self.buffer[0]
+            if self.count>0:
+                self.v_out, self.eof_out = self.v[self.head], EOF_FLAGS[self.eof[self.head]]
             else:
-                v_out, eof_out = np.zeros(self.N), False
-            return v_out, eof_out, self.bof_out, self.chainId_out
+                self.v_out, self.eof_out = self.v_idle, EOF_FLAGS[0]
+            return self.v_out, self.eof_out, self.bof_out, self.chainId_out
+
+        # Remove all elements from the input buffer at once (used by the fast engine)
+        def drain(self):
+            idx=(self.head+np.arange(self.count))%self.capacity
+            v_out = self.v[idx]
+            eof_out = EOF_BITS[self.eof[idx]]
+            bof_out = self.frameStarts(eof_out)
+            self.head, self.count = 0, 0
+            self.chainId_out = 0
+            return v_out, eof_out, bof_out
+
+        # The beginning of a frame is signaled by the end of the previous one (eof is a Tx2 boolean array)
+        def frameStarts(self,eof):
+            bof = np.empty_like(eof)
+            if len(eof)>0:
+                bof[0] = self.bof_out
+                bof[1:] = eof[:-1]
+                self.bof_out = (bool(eof[-1,0]),bool(eof[-1,1]))
+            return bof
 
     # Filter Unit
     class FilterUnit():
-        def __init__(self,N,M,FUVRF_SIZE):
-            self.v_in=np.zeros(N)
-            self.m_out=np.zeros((M,N))
+        def __init__(self,N,M,FUVRF_SIZE,arith):
+            self.arith = arith
+            self.v_in=np.zeros(N,dtype=arith.dtype)
+            self.m_out=np.zeros((M,N),dtype=arith.dtype)
+            self.m_batch=np.zeros((0,M,N),dtype=arith.dtype)
             self.eof_in = [False,False]
             self.eof_out = [False,False]
             self.bof_in = [True,True]
             self.bof_out = [True,True]
             self.chainId_in = 0
             self.chainId_out = 0
-            self.vrf=np.zeros(FUVRF_SIZE*M)
             self.config=None
+            self.kernels=None
             self.M = M
             self.N = N
+            self.vrf=np.zeros(FUVRF_SIZE*M)
 
-        def step(self,input_value):
+        # The VRF is converted into a table of bin edges every time it is loaded
+        # Note that the table is not updated if elements of the VRF are modified in place
+        @property
+        def vrf(self):
+            return self._vrf
+
+        @vrf.setter
+        def vrf(self,vals):
+            self._vrf=vals
+            self.loadEdges()
+
+        # Row addr of the table has the M+1 edges of the ranges (edges[i],edges[i+1]] stored at that address
+        def loadEdges(self):
+            vrf = self.arith.encode(self._vrf)
+            num_addr = len(vrf)//self.M
+            self.edges = np.empty((num_addr,self.M+1),dtype=vrf.dtype)
+            self.edges[:,:self.M] = vrf[:num_addr*self.M].reshape(num_addr,self.M)
+            self.edges[:,self.M] = self.arith.lastEdges(vrf,self.M)
+            # Sorted edges can be searched instead of compared against every range
+            self.sorted_edges = np.all(self.edges[:,1:]>=self.edges[:,:-1],axis=1)
+
+        # Index of the range of a given address that each value is within, if the edges of the address are sorted
+        # Values that are not within any of the M ranges get -1 or M
+        def ranges(self,v_in,addr):
+            return np.searchsorted(self.edges[addr],v_in,side='left')-1
+
+        # Check if the values of the last axis of v_in are within the M ranges of a given address
+        def filter(self,v_in,addr,m_out):
+            edges=self.edges[addr]
+            if self.sorted_edges[addr]:
+                np.equal(self.ranges(v_in,addr)[...,None,:],np.arange(self.M)[:,None],out=m_out)
+            else:
+                np.logical_and(v_in[...,None,:]>edges[:-1,None],v_in[...,None,:]<=edges[1:,None],out=m_out)
+            if self.arith.ONE!=1:
+                m_out *= self.arith.ONE
+
+        # Build the operation performed by a given chain, with all firmware branches resolved
+        @staticmethod
+        def kernel(cfg,c):
+            addr=cfg.addr[c]
             # Check if the vector is within M ranges
-            cfg=self.config[self.chainId_in]
-            log.debug('Filter input:'+str(self.v_in))
-            log.debug('Filtering using the following ranges:'+str(self.vrf[cfg.addr*self.M:cfg.addr*self.M+self.M+1]))
-            if cfg.filter==1:
-                for i in range(self.M):
-                    low_range = self.vrf[cfg.addr*self.M+i]
-                    if cfg.addr*self.M+i+1<len(self.vrf):
-                        high_range = self.vrf[cfg.addr*self.M+i+1]
-                    else:
-                        high_range = low_range+(low_range-self.vrf[cfg.addr*self.M+i-1])
-                    within_range = np.all([self.v_in>low_range, self.v_in<=high_range],axis=0)
-                    self.m_out[i]=within_range[:]
+            if cfg.filter[c]==1:
+                def run(fu):
+                    fu.filter(fu.v_in,addr,fu.m_out)
             # If we are not filtering, just pass the value through 
             else:
-                for i in range(self.M):
-                    self.m_out[i] = self.v_in if i==0 else np.zeros(self.N)
+                def run(fu):
+                    fu.m_out[0] = fu.v_in
+                    fu.m_out[1:] = 0
+            return run
+
+        def step(self,input_value):
+            self.kernels[self.chainId_in](self)
 
             self.eof_out, self.bof_out, self.chainId_out = self.eof_in, self.bof_in, self.chainId_in
-            self.v_in, self.eof_in, self.bof_in, self.chainId_in = copy(input_value)
+            # Pipeline registers are written in place. eof/bof lists are never modified, so they are shared
+            v_in, self.eof_in, self.bof_in, self.chainId_in = input_value
+            np.copyto(self.v_in,v_in)
             return self.m_out, self.eof_out, self.bof_out, self.chainId_out
 
+        # Filter a batch of TxN vectors using a given chain
+        def batch(self,v_in,chainId):
+            cfg, c = self.config, chainId
+            if len(self.m_batch)<len(v_in):
+                self.m_batch=np.zeros((len(v_in),self.M,self.N),dtype=self.arith.dtype)
+            m_out=self.m_batch[:len(v_in)]
+            if cfg.filter[c]==1:
+                self.filter(v_in,cfg.addr[c],m_out)
+            else:
+                m_out[:,0] = v_in
+                m_out[:,1:] = 0
+            return m_out
+
     # This block will reduce the matrix along a given axis
     # If M<N, then the results will be padded with zeros
     class MatrixVectorReduce():
-        def __init__(self,N,M):
-            self.m_in=np.zeros((M,N))
-            self.v_out=np.zeros(N)
+        def __init__(self,N,M,arith):
+            self.arith = arith
+            self.m_in=np.zeros((M,N),dtype=arith.dtype)
+            self.v_out=np.zeros(N,dtype=arith.dtype)
             self.eof_in = [False,False]
             self.eof_out = [False,False]
             self.bof_in = [True,True]
@@ -112,34 +552,52 @@ class emulatedHw():
             self.chainId_in = 0
             self.chainId_out = 0
             self.config=None
+            self.kernels=None
             self.N = N
             self.M = M
 
-        def step(self,input_value):
+        @staticmethod
+        def kernel(cfg,c):
             # Reduce matrix along a given axis
-            cfg=self.config[self.chainId_in]
-            if cfg.axis==0:
-                log.debug('Passing first vector through reduce unit')
-                self.v_out=self.m_in[0]
-            elif cfg.axis==1:
-                log.debug('Reducing matrix along N axis (axis = '+str(cfg.axis)+')')
-                self.v_out=np.sum(self.m_in,axis=0)
-            elif cfg.axis==2:
-                log.debug('Reducing matrix along M axis (axis = '+str(cfg.axis)+')')
-                self.v_out=np.sum(self.m_in,axis=1)
-                if self.N!=self.M:
-                    log.debug('Padding results with '+str(self.N-self.M)+' zeros')
-                    self.v_out=np.concatenate((self.v_out,np.zeros(self.N-self.M)))
+            axis=cfg.axis[c]
+            if axis==0:
+                def run(mvru):
+                    np.copyto(mvru.v_out,mvru.m_in[0])
+            elif axis==1:
+                def run(mvru):
+                    mvru.arith.sum(mvru.m_in,axis=0,out=mvru.v_out)
+            elif axis==2:
+                # If M<N the results are padded with zeros
+                def run(mvru):
+                    mvru.arith.sum(mvru.m_in,axis=1,out=mvru.v_out[:mvru.M])
+                    mvru.v_out[mvru.M:]=0
+            return run
+
+        def step(self,input_value):
+            self.kernels[self.chainId_in](self)
 
             self.eof_out, self.bof_out, self.chainId_out    = self.eof_in, self.bof_in, self.chainId_in
-            self.m_in, self.eof_in, self.bof_in, self.chainId_in = copy(input_value)
+            m_in, self.eof_in, self.bof_in, self.chainId_in = input_value
+            np.copyto(self.m_in,m_in)
             return self.v_out, self.eof_out, self.bof_out, self.chainId_out
 
+        # Reduce a batch of TxMxN matrices using a given chain
+        def batch(self,m_in,chainId):
+            axis=self.config.axis[chainId]
+            if axis==0:
+                return m_in[:,0].copy()
+            elif axis==1:
+                return self.arith.sum(m_in,axis=1)
+            v_out=np.zeros((len(m_in),self.N),dtype=self.arith.dtype)
+            v_out[:,:self.M]=self.arith.sum(m_in,axis=2)
+            return v_out
+
     # This block will reduce a vector to a scalar and pad with zeros
     class VectorScalarReduce():
-        def __init__(self,N):
-            self.v_in=np.zeros(N)
-            self.v_out=np.zeros(N)
+        def __init__(self,N,arith):
+            self.arith = arith
+            self.v_in=np.zeros(N,dtype=arith.dtype)
+            self.v_out=np.zeros(N,dtype=arith.dtype)
             self.eof_in = [False,False]
             self.eof_out = [False,False]
             self.bof_in = [True,True]
@@ -147,28 +605,42 @@ class emulatedHw():
             self.chainId_in = 0
             self.chainId_out = 0
             self.config=None
+            self.kernels=None
             self.N = N
 
+        @staticmethod
+        def kernel(cfg,c):
+            if cfg.op[c]==0:
+                def run(vsru):
+                    np.copyto(vsru.v_out,vsru.v_in)
+            elif cfg.op[c]==1:
+                def run(vsru):
+                    vsru.v_out[0]=vsru.arith.sum(vsru.v_in)
+                    vsru.v_out[1:]=0
+            return run
+
         def step(self,input_value):
-            # Reduce matrix along a given axis
-            cfg=self.config[self.chainId_in]
-            
-            if cfg.op==0:
-                log.debug('Passing first vector through vs reduce unit')
-                self.v_out=self.v_in
-            elif cfg.op==1:
-                log.debug('Sum vector scalar reduce')
-                self.v_out=np.concatenate(([np.sum(self.v_in)],np.zeros(self.N-1))) 
-              
+            self.kernels[self.chainId_in](self)
+
             self.eof_out, self.bof_out, self.chainId_out = self.eof_in, self.bof_in, self.chainId_in
-            self.v_in, self.eof_in, self.bof_in, self.chainId_in = copy(input_value)
+            v_in, self.eof_in, self.bof_in, self.chainId_in = input_value
+            np.copyto(self.v_in,v_in)
             return self.v_out, self.eof_out, self.bof_out, self.chainId_out
 
+        # Reduce a batch of TxN vectors using a given chain
+        def batch(self,v_in,chainId):
+            if self.config.op[chainId]==0:
+                return v_in
+            v_out=np.zeros((len(v_in),self.N),dtype=self.arith.dtype)
+            v_out[:,0]=self.arith.sum(v_in,axis=1)
+            return v_out
+
     # This block will reduce the matrix along a given axis
     class VectorVectorALU():
-        def __init__(self,N,VVVRF_SIZE):
-            self.v_in=np.zeros(N)
-            self.v_out=np.zeros(N)
+        def __init__(self,N,VVVRF_SIZE,arith):
+            self.arith = arith
+            self.v_in=np.zeros(N,dtype=arith.dtype)
+            self.v_out=np.zeros(N,dtype=arith.dtype)
             self.eof_in = [False,False]
             self.eof_out = [False,False]
             self.bof_in = [False,False]
@@ -177,8 +649,9 @@ class emulatedHw():
             self.chainId_out = 0
             self.vrf=np.zeros(N*VVVRF_SIZE)
             self.config=None
-            self.v_out_d1=np.zeros(N)
-            self.v_out_d2=np.zeros(N)
+            self.kernels=None
+            self.v_out_d1=np.zeros(N,dtype=arith.dtype)
+            self.v_out_d2=np.zeros(N,dtype=arith.dtype)
             self.eof_out_d1 = [False,False]
             self.eof_out_d2 = [False,False]
             self.bof_out_d1 = [True,True]
@@ -186,12 +659,41 @@ class emulatedHw():
             self.chainId_out_d2 = 0
             self.chainId_out_d1 = 0
             self.N = N
-            self.minicache = np.zeros(N)
+            self.minicache = np.zeros(N,dtype=arith.dtype)
+
+        # Values written to the VRF are encoded with the arithmetic of the emulator
+        @property
+        def vrf(self):
+            return self._vrf
+
+        @vrf.setter
+        def vrf(self,vals):
+            self._vrf=self.arith.encode(vals)
+
+        @staticmethod
+        def kernel(cfg,c):
+            op, addr, cond = cfg.op[c], cfg.addr[c], cfg.cond[c]
+            cache, cache_addr, cache_cond = cfg.cache[c], cfg.cache_addr[c], cfg.cache_cond[c]
+            # Checking if we should use minicache or input vector as operator
+            load, save = cfg.minicache[c] in [1,3], cfg.minicache[c] in [2,3]
+            def run(vvalu):
+                N = vvalu.N
+                operator = vvalu.minicache if load else vvalu.v_in
+                if op!=0 and conditionMet(cond,vvalu.eof_in,vvalu.bof_in):
+                    vvalu.arith.ALU[op](operator,vvalu.vrf[addr*N:addr*N+N],out=vvalu.v_out_d1)
+                # ALU is passing values through
+                else:
+                    np.copyto(vvalu.v_out_d1,operator)
+                if cache and conditionMet(cache_cond,vvalu.eof_in,vvalu.bof_in):
+                    vvalu.vrf[cache_addr*N:cache_addr*N+N] = vvalu.v_out_d1
+                if save:
+                    np.copyto(vvalu.minicache,vvalu.v_out_d1)
+            return run
 
         def step(self,input_value):
             # Delay for 2 cycles, so this FU takes 3 cycles (read, calculate, write)
-            self.v_out    = self.v_out_d2
-            self.v_out_d2 = self.v_out_d1
+            # The three output buffers rotate, and the new result overwrites the one that was just shifted out
+            self.v_out, self.v_out_d2, self.v_out_d1 = self.v_out_d2, self.v_out_d1, self.v_out
             self.eof_out  = self.eof_out_d2
             self.eof_out_d2  = self.eof_out_d1
             self.eof_out_d1  = self.eof_in
@@ -201,192 +703,1038 @@ class emulatedHw():
             self.chainId_out  = self.chainId_out_d2
             self.chainId_out_d2  = self.chainId_out_d1
             self.chainId_out_d1  = self.chainId_in
-            cfg=self.config[self.chainId_in]
-            condition_met = ((not cfg.cond1['last']     or (cfg.cond1['last']     and     self.eof_in[0])) and
-                    		 (not cfg.cond1['notlast']  or (cfg.cond1['notlast']  and not self.eof_in[0])) and
-                    		 (not cfg.cond1['first']    or (cfg.cond1['first']    and     self.bof_in[0])) and
-                    		 (not cfg.cond1['notfirst'] or (cfg.cond1['notfirst'] and not self.bof_in[0])) and
-                             (not cfg.cond2['last']     or (cfg.cond2['last']     and     self.eof_in[1])) and
-                             (not cfg.cond2['notlast']  or (cfg.cond2['notlast']  and not self.eof_in[1])) and
-                             (not cfg.cond2['first']    or (cfg.cond2['first']    and     self.bof_in[1])) and
-                             (not cfg.cond2['notfirst'] or (cfg.cond2['notfirst'] and not self.bof_in[1])))
-
-            # Checking if we should use minicache or input vector as operator
-            if cfg.minicache == 1 or cfg.minicache==3:
-                operator = self.minicache
-            else:
-                operator = self.v_in
-
-            if cfg.op==0 or not condition_met:
-                log.debug('ALU is passing values through')
-                self.v_out_d1 = operator
-            elif cfg.op==1:
-                log.debug('Adding using vector-vector ALU')
-                self.v_out_d1 = operator + self.vrf[cfg.addr*self.N:cfg.addr*self.N+self.N]
-            elif cfg.op==2:
-                log.debug('Multiplying using vector-vector ALU')
-                self.v_out_d1 = operator * self.vrf[cfg.addr*self.N:cfg.addr*self.N+self.N]
-            elif cfg.op==3:
-                log.debug('Subtracting using vector-vector ALU')
-                self.v_out_d1 = operator - self.vrf[cfg.addr*self.N:cfg.addr*self.N+self.N]
-            elif cfg.op==4:
-                log.debug('Subtracting using vector-vector ALU')
-                self.v_out_d1 = np.maximum(operator, self.vrf[cfg.addr*self.N:cfg.addr*self.N+self.N])
-
-            cache_condition_met = ((not cfg.cache_cond1['last']     or (cfg.cache_cond1['last']     and     self.eof_in[0])) and
-                             (not cfg.cache_cond1['notlast']  or (cfg.cache_cond1['notlast']  and not self.eof_in[0])) and
-                             (not cfg.cache_cond1['first']    or (cfg.cache_cond1['first']    and     self.bof_in[0])) and
-                             (not cfg.cache_cond1['notfirst'] or (cfg.cache_cond1['notfirst'] and not self.bof_in[0])) and
-                             (not cfg.cache_cond2['last']     or (cfg.cache_cond2['last']     and     self.eof_in[1])) and
-                             (not cfg.cache_cond2['notlast']  or (cfg.cache_cond2['notlast']  and not self.eof_in[1])) and
-                             (not cfg.cache_cond2['first']    or (cfg.cache_cond2['first']    and     self.bof_in[1])) and
-                             (not cfg.cache_cond2['notfirst'] or (cfg.cache_cond2['notfirst'] and not self.bof_in[1])))
-            if cfg.cache & cache_condition_met:
-                self.vrf[cfg.cache_addr*self.N:cfg.cache_addr*self.N+self.N] = self.v_out_d1 
-            if cfg.minicache==2 or cfg.minicache==3:
-                self.minicache = copy(self.v_out_d1) 
+            self.kernels[self.chainId_in](self)
             
-            self.v_in, self.eof_in, self.bof_in, self.chainId_in = copy(input_value)
+            v_in, self.eof_in, self.bof_in, self.chainId_in = input_value
+            np.copyto(self.v_in,v_in)
             return self.v_out, self.eof_out, self.bof_out, self.chainId_out
 
+        # Process a batch of vectors for all chains
+        # v_in maps each chainId to its TxN inputs. Results are the same as stepping through
+        # the vectors one by one, with chains of the same vector executed in order
+        def batch(self,v_in,eof_in,bof_in):
+            cfg={c:struct(**{field:values[c] for field, values in vars(self.config).items()}) for c in v_in}
+            cond={c:batchCondition(cfg[c].cond,eof_in,bof_in) for c in v_in}
+            cache_cond={c:batchCondition(cfg[c].cache_cond,eof_in,bof_in) for c in v_in}
+            chains, T, N = list(v_in), len(eof_in), self.N
+            C = len(chains)
+
+            # Which vector and chain wrote the value that each chain reads from the cache and from the minicache
+            # only depends on the conditions, so it is found for the whole batch before computing any value
+            # Writes are numbered t*C+p for vector t and chain at position p, and -1 is the value before the batch
+            writes={}
+            for p, c in enumerate(chains):
+                if cfg[c].cache:
+                    writes.setdefault(cfg[c].cache_addr,[]).append((p,cache_cond[c]))
+                if cfg[c].minicache in [2,3]:
+                    writes.setdefault('minicache',[]).append((p,np.ones(T,dtype=bool)))
+            last={}
+            for loc, chain_writes in writes.items():
+                written=np.full((T,C),-1)
+                for p, mask in chain_writes:
+                    written[mask,p]=np.flatnonzero(mask)*C+p
+                last[loc]=np.concatenate(([-1],np.maximum.accumulate(written.ravel())))
+            def source(loc,p):
+                return last[loc][np.arange(T)*C+p] if loc in last else np.full(T,-1)
+
+            # Chains are computed for all vectors at once, after the chains they read from
+            # A chain may only read its own results when it accumulates them in the cache (e.g. histograms)
+            load={c:source('minicache',p) for p, c in enumerate(chains) if cfg[c].minicache in [1,3]}
+            read={c:np.where(cond[c],source(cfg[c].addr,p),-1) for p, c in enumerate(chains) if cfg[c].op!=0}
+            deps={}
+            for p, c in enumerate(chains):
+                deps[c]={chains[s%C] for s in np.unique(np.concatenate((load.get(c,[-1]),read.get(c,[-1])))) if s>=0}
+                if c in deps[c] and (c in load and np.any((load[c]>=0) & (load[c]%C==p)) or not self.arith.accumulates(cfg[c].op)):
+                    return self.sequentialBatch(v_in,cfg,cond,cache_cond)
+            order=[]
+            while len(order)<C:
+                ready=[c for c in chains if c not in order and deps[c]-{c}<=set(order)]
+                # Chains that depend on each other are processed vector by vector
+                if len(ready)==0:
+                    return self.sequentialBatch(v_in,cfg,cond,cache_cond)
+                order.append(ready[0])
+
+            v_out={}
+            # Values read from a location, given the writes they come from
+            def value(loc,src):
+                vals=np.empty((T,N),dtype=self.arith.dtype)
+                before=self.minicache if loc=='minicache' else self.vrf[loc*N:loc*N+N]
+                vals[src<0]=before
+                for s in np.unique(src[src>=0]%C):
+                    sel=(src>=0) & (src%C==s)
+                    vals[sel]=v_out[chains[s]][src[sel]//C]
+                return vals
+
+            for c in order:
+                p, op = chains.index(c), cfg[c].op
+                v_out[c]=value('minicache',load[c]) if c in load else np.array(v_in[c],dtype=self.arith.dtype)
+                if op==0:
+                    continue
+                alu=self.arith.ALU[op]
+                own=read[c]>=0
+                own[own]=read[c][own]%C==p
+                other=cond[c] & ~own
+                v_out[c][other]=alu(v_out[c][other],value(cfg[c].addr,read[c])[other])
+                if np.any(own):
+                    # Accumulate over the vectors this chain caches, restarting every time the cached value is not read back
+                    cached=np.flatnonzero(cache_cond[c])
+                    acc=v_out[c][cached]
+                    starts=np.concatenate(([0],np.flatnonzero(~own[cached]),[len(cached)]))
+                    for begin, end in zip(starts[:-1],starts[1:]):
+                        self.arith.accumulate(op,acc[begin:end])
+                    v_out[c][cached]=acc
+                    # Vectors that are not cached read the last value cached before them
+                    rest=own & ~cache_cond[c]
+                    v_out[c][rest]=alu(v_out[c][rest],v_out[c][read[c][rest]//C])
+
+            # Only the last write to each location remains
+            for loc in last:
+                s=last[loc][-1]
+                if s<0:
+                    continue
+                if loc=='minicache':
+                    np.copyto(self.minicache,v_out[chains[s%C]][s//C])
+                else:
+                    self.vrf[loc*N:loc*N+N]=v_out[chains[s%C]][s//C]
+            return {c:v_out[c] for c in chains}
+
+        # Process a batch of vectors one by one when chains depend on each other through the caches
+        def sequentialBatch(self,v_in,cfg,cond,cache_cond):
+            v_out={c:np.empty((len(v_in[c]),self.N),dtype=self.arith.dtype) for c in v_in}
+            N = self.N
+            for t in range(len(cond[next(iter(v_in))])):
+                for c in v_in:
+                    if cfg[c].minicache == 1 or cfg[c].minicache==3:
+                        operator = self.minicache
+                    else:
+                        operator = v_in[c][t]
+                    if cfg[c].op==0 or not cond[c][t]:
+                        v_out[c][t] = operator
+                    else:
+                        v_out[c][t] = self.arith.ALU[cfg[c].op](operator,self.vrf[cfg[c].addr*N:cfg[c].addr*N+N])
+                    if cfg[c].cache and cache_cond[c][t]:
+                        self.vrf[cfg[c].cache_addr*N:cfg[c].cache_addr*N+N] = v_out[c][t]
+                    if cfg[c].minicache==2 or cfg[c].minicache==3:
+                        np.copyto(self.minicache,v_out[c][t])
+            return v_out
+
     # Packs data efficiently
     class DataPacker():
-        def __init__(self,N,M):
-            self.v_in=np.zeros(N)
-            self.v_out=np.zeros(N)
+        def __init__(self,N,M,arith):
+            self.arith = arith
+            self.v_in=np.zeros(N,dtype=arith.dtype)
+            self.v_out=np.zeros(N,dtype=arith.dtype)
             self.eof_in = [False,False]
             self.bof_in = [True,True]
             self.chainId_in = 0
             self.v_out_valid=0
             self.v_out_size=0
+            # Number of eof[0] and eof[1] flags seen, and the (epoch1,epoch2,chain) of the value that completed v_out
+            self.epoch=[0,0]
+            self.v_out_key=(0,0,0)
             self.config=None
+            self.kernels=None
             self.N = N
 
-        def step(self,input_value):
-            cfg=self.config[self.chainId_in]
-            if (cfg.commit and 
-                (not cfg.cond1['last']     or (cfg.cond1['last']     and     self.eof_in[0])) and
-                (not cfg.cond1['notlast']  or (cfg.cond1['notlast']  and not self.eof_in[0])) and
-                (not cfg.cond1['first']    or (cfg.cond1['first']    and     self.bof_in[0])) and
-                (not cfg.cond1['notfirst'] or (cfg.cond1['notfirst'] and not self.bof_in[0])) and
-                (not cfg.cond2['last']     or (cfg.cond2['last']     and     self.eof_in[1])) and
-                (not cfg.cond2['notlast']  or (cfg.cond2['notlast']  and not self.eof_in[1])) and
-                (not cfg.cond2['first']    or (cfg.cond2['first']    and     self.bof_in[1])) and
-                (not cfg.cond2['notfirst'] or (cfg.cond2['notfirst'] and not self.bof_in[1]))):
-                if self.v_out_size==0:
-                    self.v_out = self.v_in[:cfg.size]
-                else:
-                    self.v_out = np.append(self.v_out,self.v_in[:cfg.size])
-                self.v_out_size=self.v_out_size+cfg.size
-                if self.v_out_size==self.N:
-                    log.debug('Data Packer full. Pushing values to Trace Buffer')
-                    self.v_out_valid=1
-                    self.v_out_size = 0
+        @staticmethod
+        def kernel(cfg,c):
+            commit, size, cond = cfg.commit[c], cfg.size[c], cfg.cond[c]
+            # Values committed in half precision are packed in pairs, taking half of the words
+            half = cfg.precision[c]==1
+            words = size//2 if half else size
+            # A vector leaves its epoch once its last chain has gone through
+            last = c>0 and c==len(cfg.commit)-1
+            def run(dp):
+                commit_values(dp)
+                if last:
+                    dp.epoch[0]+=bool(dp.eof_in[0])
+                    dp.epoch[1]+=bool(dp.eof_in[1])
+            def commit_values(dp):
+                if commit and conditionMet(cond,dp.eof_in,dp.bof_in):
+                    v_in = dp.arith.pack(dp.v_in[:size]) if half else dp.v_in
+                    # Values are packed in place. Values that do not fit in N are dropped, since an overflowed packer never pushes again
+                    end=min(dp.v_out_size+words,dp.N)
+                    if dp.v_out_size<end:
+                        dp.v_out[dp.v_out_size:end] = v_in[:end-dp.v_out_size]
+                    dp.v_out_size=dp.v_out_size+words
+                    if dp.v_out_size==dp.N:
+                        log.debug('Data Packer full. Pushing values to Trace Buffer')
+                        dp.v_out_valid=1
+                        dp.v_out_key=(dp.epoch[0],dp.epoch[1],c)
+                        dp.v_out_size = 0
+                    else:
+                        dp.v_out_valid=0
                 else:
-                    self.v_out_valid=0
+                    dp.v_out_valid=0
+            return run
+
+        def step(self,input_value):
+            self.kernels[self.chainId_in](self)
+            v_in, self.eof_in, self.bof_in, self.chainId_in = input_value
+            np.copyto(self.v_in,v_in)
+            return self.v_out, self.v_out_valid, self.v_out_key
+
+        # Pack a batch of vectors from all chains, returning all full vectors sent to the trace buffer
+        # For each full vector, also returns when the value that completed it was dispatched (t*num_chains+chain-1)
+        # and the (epoch1,epoch2,chain) of that value
+        def batch(self,v_in,eof_in,bof_in):
+            # Epochs of each vector, counting the eof flags of the vectors before it
+            epochs = self.epoch+np.cumsum(eof_in,axis=0)-eof_in
+            self.epoch = [int(e) for e in epochs[-1]+eof_in[-1]] if len(eof_in)>0 else self.epoch
+
+            # Collect committed values in the order in which they would reach the data packer
+            num_chains=len(v_in)
+            order, sizes, values = [], [], []
+            cfg=self.config
+            for idx, c in enumerate(v_in):
+                if cfg.commit[c]:
+                    t = np.flatnonzero(batchCondition(cfg.cond[c],eof_in,bof_in))
+                    order.append(t*num_chains+idx)
+                    if cfg.precision[c]==1:
+                        sizes.append(np.full(len(t),cfg.size[c]//2))
+                        values.append(self.arith.pack(v_in[c][t,:cfg.size[c]]))
+                    else:
+                        sizes.append(np.full(len(t),cfg.size[c]))
+                        values.append(v_in[c][t,:cfg.size[c]])
+            if len(order)==0:
+                return np.zeros((0,self.N),dtype=self.v_out.dtype), np.zeros(0,dtype=int), np.zeros((0,3),dtype=int)
+            order, sizes = np.concatenate(order), np.concatenate(sizes)
+            position = np.empty(len(order),dtype=int)
+            position[np.argsort(order,kind='stable')] = np.arange(len(order))
+
+            # Values that were already in the data packer go first
+            sorted_sizes = np.concatenate(([self.v_out_size],sizes[np.argsort(order,kind='stable')]))
+            ends = np.cumsum(sorted_sizes)
+            packed = np.empty(ends[-1],dtype=self.v_out.dtype)
+            packed[:min(self.v_out_size,self.N)] = self.v_out[:self.v_out_size]
+            count=0
+            for v in values:
+                starts = ends[position[count:count+len(v)]]
+                packed[starts[:,None]+np.arange(v.shape[1])] = v
+                count+=len(v)
+
+            # Data is pushed every time we pack exactly N values. Once N is exceeded nothing else is pushed.
+            previous = ends[:-1] % self.N
+            overflow = np.flatnonzero(previous+sorted_sizes[1:]>self.N)
+            if self.v_out_size>self.N:
+                last_valid = 0
+            elif len(overflow)>0:
+                last_valid = overflow[0]
             else:
-                self.v_out_valid=0
-            self.v_in, self.eof_in, self.bof_in, self.chainId_in = copy(input_value)
-            return self.v_out, self.v_out_valid
+                last_valid = len(sorted_sizes)-1
+            num_pushed = ends[last_valid]//self.N if self.v_out_size<=self.N else 0
+            v_out = packed[:num_pushed*self.N].reshape(num_pushed,self.N)
+
+            # Leave the data packer as it would be after the last vector
+            self.v_out_size = int(ends[-1]-num_pushed*self.N)
+            if num_pushed>0:
+                self.v_out[:] = v_out[-1]
+            partial = min(self.v_out_size,self.N)
+            self.v_out[:partial] = packed[num_pushed*self.N:num_pushed*self.N+partial]
+            self.v_out_valid = 0
+            dispatched = np.sort(order)[np.searchsorted(ends[1:],self.N*np.arange(1,num_pushed+1))]
+            keys = np.column_stack((epochs[dispatched//num_chains],dispatched%num_chains+1))
+            if num_pushed>0:
+                self.v_out_key = tuple(int(k) for k in keys[-1])
+            return v_out, dispatched, keys
 
     # Packs data efficiently
     class TraceBuffer():
-        def __init__(self,N,TB_SIZE):
-            self.input=np.zeros(N)
-            self.mem=np.zeros((TB_SIZE,N))
+        def __init__(self,N,TB_SIZE,arith):
+            self.input=np.zeros(N,dtype=arith.dtype)
+            self.mem=np.zeros((TB_SIZE,N),dtype=arith.dtype)
             self.size=0
+            self.count=0
             self.TB_SIZE=TB_SIZE
+            self.sink=None
 
-        def step(self,packed_data):
-            output, output_valid = packed_data
+        # count is the sequence number of the next word, so words can be told apart after the buffer wraps around
+        def step(self,packed_data,cycle):
+            output, output_valid, key = packed_data
             if output_valid:
+                if self.sink is not None:
+                    self.sink.write(self.count,[cycle],output[None],[key])
                 if self.size==self.TB_SIZE:
                     self.size=0
                 self.mem[self.size]=output
                 self.size=self.size+1
-            self.input=copy(packed_data)
+                self.count=self.count+1
+            self.input=packed_data[0]
+
+        # Store a batch of KxN packed vectors, committed on the given K cycles with the given Kx3 keys
+        def batch(self,packed_data,cycles,keys):
+            K=len(packed_data)
+            if K==0:
+                return
+            if self.sink is not None:
+                self.sink.write(self.count,cycles,packed_data,keys)
+            # Only the last TB_SIZE vectors survive in the circular buffer
+            addr = (self.size+np.arange(K)) % self.TB_SIZE
+            kept = min(K,self.TB_SIZE)
+            self.mem[addr[-kept:]]=packed_data[-kept:]
+            self.size = int(addr[-1])+1
+            self.count += K
+
+    # Connect the building blocks once, so that stepping does not need to look them up every cycle
+    def buildPipeline(self):
+        stages={'InputBuffer':        lambda chain: self.ib.step(),
+                'FilterReduceUnit':   lambda chain: self.mvru.step(self.fu.step(chain)),
+                'VectorVectorALU':    lambda chain: self.vvalu.step(chain),
+                'VectorScalarReduce': lambda chain: self.vsru.step(chain),
+                'DataPacker':         lambda chain: self.dp.step(chain),
+                'TraceBuffer':        lambda packed_data: self.tb.step(packed_data,self.cycle)}
+        for b in self.BUILDING_BLOCKS:
+            assert b in stages, "Unknown building block "+b
+        self.pipeline=[stages[b] for b in self.BUILDING_BLOCKS]
 
     def step(self):
         log.debug('New step')
 
         # Perform operations according to how building blocks are connected
-        for b in self.BUILDING_BLOCKS:
-            if b=='InputBuffer':
-                chain = self.ib.step()
-                self.log['ib'].append(chain)
-            elif b=='FilterReduceUnit':
-                chain = self.fu.step(chain)
-                self.log['fu'].append(chain)
-                chain = self.mvru.step(chain)
-                self.log['mvru'].append(chain)
-            elif b=='VectorVectorALU':
-                chain = self.vvalu.step(chain)
-                self.log['vvalu'].append(chain)
-            elif b=='VectorScalarReduce':
-                chain = self.vsru.step(chain)
-                self.log['vsru'].append(chain)
-            elif b=='DataPacker':
-                packed_data = self.dp.step(chain)
-                self.log['dp'].append(packed_data)
-            elif b=='TraceBuffer':
-                self.tb.step(packed_data)
-                self.log['tb'].append(self.tb.mem)
-            else:
-                assert False, "Unknown building block "+b
-        
+        chain = None
+        for stage in self.pipeline:
+            chain = stage(chain)
+        self.log.record(self.cycle)
+        self.cycle+=1
+
+    # Record signals while running (see probeRecorder)
+    def probe(self,signals,depth=None,decimation=1):
+        self.log.probe(signals,depth,decimation)
+
+    # Send every word committed to the trace buffer to a sink (see traceSink), or stop if sink is None
+    # The trace buffer still only keeps the last TB_SIZE words, so memory does not grow with the length of the run
+    def stream(self,sink=None):
+        if self.tb.sink is not None:
+            self.tb.sink.close()
+        self.tb.sink = None if sink is None else traceSink(sink,self.tb.mem.shape[1],self.tb.mem.dtype)
 
     # Pushes values to the input of the chain
     def push(self,pushed_vals):
         self.ib.push(pushed_vals)
 
+    # Pushes a TxN array (or any iterable of N-element vectors) with optional eof flags of length T
+    # backpressure sets what happens when the input buffer is full:
+    #   'block' processes vectors from the input buffer until all vectors are pushed
+    #   'drop'  discards the vectors that do not fit, counting them in ib.dropped
+    #   'raise' fails as soon as the input buffer overflows
+    # Returns the number of vectors dropped
+    def push_many(self,vectors,eof1=None,eof2=None,backpressure='block'):
+        dropped = self.pushStream(self.ib.push_many,vectors,eof1,eof2,backpressure)
+        self.ib.dropped += dropped
+        return dropped
+
+    # Feed vectors to a function that pushes as many of them as possible and returns how many it pushed
+    def pushStream(self,push,vectors,eof1,eof2,backpressure):
+        assert backpressure in ['block','drop','raise'], "backpressure must be 'block', 'drop' or 'raise'"
+        dropped = 0
+        if isinstance(vectors,np.ndarray):
+            T = len(vectors)
+            eof1 = np.zeros(T,dtype=bool) if eof1 is None else np.asarray(eof1,dtype=bool)
+            eof2 = np.zeros(T,dtype=bool) if eof2 is None else np.asarray(eof2,dtype=bool)
+            assert len(eof1)==T and len(eof2)==T, "eof flags must have one value per vector"
+            blocks = [(vectors,eof1,eof2)]
+        else:
+            size = self.ib.capacity if self.ENGINE=='cycle' else max(1,BATCH_ELEMENTS//(self.fu.M*self.fu.N))
+            blocks = chunks(vectors,eof1,eof2,size)
+        for v, e1, e2 in blocks:
+            pushed = push(v,e1,e2)
+            while pushed<len(v):
+                if backpressure=='raise':
+                    assert False, "Input buffer overflowed"
+                elif backpressure=='drop':
+                    dropped += len(v)-pushed
+                    break
+                elif self.ENGINE=='fast':
+                    # The fast engine consumes all vectors at once, so the remaining ones skip the input buffer
+                    # The pipeline is only flushed once everything has been pushed
+                    self.batchRun(*self.ib.drain())
+                    e = np.stack((e1[pushed:],e2[pushed:]),axis=1)
+                    self.batchRun(self.arith.encode(v[pushed:]),e,self.ib.frameStarts(e))
+                    pushed = len(v)
+                else:
+                    self.step()
+                    pushed += push(v[pushed:],e1[pushed:],e2[pushed:])
+        return dropped
+
     def config(self,fw=None):
         # Configure processor
-        # Fixme - For some reason I need to append a chain of zeros here
-        no_cond={'last':False,'notlast':False,'first':False,'notfirst':False}
-        self.fu.config=[struct(filter=0,addr=0)]
-        self.mvru.config=[struct(axis=0)]
-        self.vsru.config=[struct(op=0)]
-        self.vvalu.config=[struct(op=0,addr=0,cache=0,cache_addr=0,cond1=copy(no_cond),cond2=copy(no_cond),minicache=0,cache_cond1=copy(no_cond),cache_cond2=copy(no_cond))]
-        self.dp.config=[struct(commit=0,size=0,cond1=copy(no_cond),cond2=copy(no_cond))]
+        # Chain 0 is a pass through, so the firmware table always starts with a row of zeros
+        table = np.zeros(1,dtype=FIRMWARE_TABLE)
         self.ib.config=struct(num_chains=1)
         if fw is not None:
             self.ib.config=struct(num_chains=fw['valid_chains']+1)
-            for idx in range(fw['valid_chains']):
-                self.fu.config.append(fw['fu'][idx])
-                self.mvru.config.append(fw['mvru'][idx])
-                self.vsru.config.append(fw['vsru'][idx])
-                self.vvalu.config.append(fw['vvalu'][idx])
-                self.dp.config.append(fw['dp'][idx])
-
-    def initialize_fu(vals):
+            table = np.concatenate((table,fw['table'][:fw['valid_chains']]))
+        self.firmware_table = table
+
+        # Each block gets one list per field of the table, so chains are dispatched with plain integers
+        blocks=[['fu',self.fu],['mvru',self.mvru],['vsru',self.vsru],['vvalu',self.vvalu],['dp',self.dp]]
+        for name, block in blocks:
+            block.config=struct(**{field[len(name)+1:]:table[field].tolist() for field in table.dtype.names if field.startswith(name+'_')})
+        self.fu.loadEdges()
+
+        # Build one kernel per chain and block. Kernels are reused when the same firmware is loaded again
+        key=(type(self).__name__,table.tobytes(),tuple(self.BUILDING_BLOCKS))
+        if key not in KERNEL_CACHE:
+            KERNEL_CACHE[key]={name:[block.kernel(block.config,c) for c in range(len(table))] for name, block in blocks}
+        kernels=KERNEL_CACHE[key]
+        for name, block in blocks:
+            block.kernels=kernels[name]
+
+    def initialize_fu(self,vals):
         self.fu.vrf=vals
 
-    def run(self,steps=50):
-        # Keep stepping through the circuit as long as we have instructions to execute
-        for i in range(steps):
+    # Transaction-level emulation: all vectors in the input buffer are processed at once
+    # Produces the same trace buffer as stepping through the circuit until all vectors are processed
+    # Returns the number of cycles the cycle engine would take to process the same vectors
+    def fastRun(self):
+        start = self.cycle
+        self.batchRun(*self.ib.drain())
+        # The last chain still needs to go through the pipeline
+        if self.in_flight:
+            self.cycle += self.PIPELINE_DEPTH
+            self.in_flight = False
+        return self.cycle-start
+
+    # Process TxN vectors with their Tx2 eof and bof flags
+    def batchRun(self,v_in,eof,bof):
+        chains = range(1,self.ib.config.num_chains)
+        # Each vector is dispatched once per chain (or once if there are no chains)
+        self.cycle += len(v_in)*max(1,len(chains))
+        if len(v_in)==0 or len(chains)==0:
+            return
+        self.in_flight = True
+        stages = self.BUILDING_BLOCKS[1:-2]
+        vvalu_stage = stages.index('VectorVectorALU') if 'VectorVectorALU' in stages else len(stages)
+
+        # Process vectors in chunks to limit the memory used by the filter unit
+        chunk = max(1,BATCH_ELEMENTS//(self.fu.M*self.fu.N))
+        start = self.cycle-len(v_in)*len(chains)
+        for begin in range(0,len(v_in),chunk):
+            v, e, b = v_in[begin:begin+chunk], eof[begin:begin+chunk], bof[begin:begin+chunk]
+            chain = {c:self.stageBatch(stages[:vvalu_stage],v,c) for c in chains}
+            if vvalu_stage<len(stages):
+                chain = self.vvalu.batch(chain,e,b)
+            chain = {c:self.stageBatch(stages[vvalu_stage+1:],chain[c],c) for c in chains}
+            # Values reach the trace buffer PIPELINE_DEPTH cycles after being dispatched
+            packed_data, dispatched, keys = self.dp.batch(chain,e,b)
+            self.tb.batch(packed_data,start+begin*len(chains)+dispatched+self.PIPELINE_DEPTH,keys)
+
+    # Process a batch of vectors of a given chain through stateless building blocks
+    def stageBatch(self,stages,v,chainId):
+        for b in stages:
+            if b=='FilterReduceUnit':
+                v = self.filterReduceBatch(v,chainId)
+            elif b=='VectorScalarReduce':
+                v = self.vsru.batch(v,chainId)
+            else:
+                assert False, "Unknown building block "+b
+        return v
+
+    # Filter and reduce a batch of vectors of a given chain
+    # When the edges are sorted, each value is within at most one range, so values are counted per range
+    # instead of building the TxMxN matrices of the filter unit
+    def filterReduceBatch(self,v,chainId):
+        fu, addr, axis = self.fu, self.fu.config.addr[chainId], self.mvru.config.axis[chainId]
+        if fu.config.filter[chainId]!=1 or axis==0 or not fu.sorted_edges[addr]:
+            return self.mvru.batch(fu.batch(v,chainId),chainId)
+        ranges = fu.ranges(v,addr)
+        within = (ranges>=0) & (ranges<fu.M)
+        v_out = np.zeros((len(v),fu.N),dtype=self.arith.dtype)
+        if axis==1:
+            v_out[within] = self.arith.ONE
+        else:
+            counts = np.bincount((np.arange(len(v))[:,None]*fu.M+ranges)[within],minlength=len(v)*fu.M)
+            v_out[:,:fu.M] = self.arith.count(counts.reshape(len(v),fu.M))
+        return v_out
+
+    # Chains other than chain 0 (a pass through) that are still being processed
+    def busy(self):
+        return (self.ib.count>0 or self.fu.chainId_in!=0 or self.mvru.chainId_in!=0 or self.vsru.chainId_in!=0 or
+                self.vvalu.chainId_in!=0 or self.vvalu.chainId_out_d1!=0 or self.vvalu.chainId_out_d2!=0 or
+                self.dp.chainId_in!=0)
+
+    # Step through the circuit for a given number of cycles, or until it is drained if steps is None
+    def cycleRun(self,steps):
+        cycles, idle = 0, 0
+        while steps is None or cycles<steps:
+            if self.busy():
+                idle = 0
+            elif steps is None:
+                break
+            elif idle>=self.PIPELINE_DEPTH and not self.log.everyCycle():
+                # Once only chain 0 has gone through every stage, stepping does not change the circuit anymore
+                self.cycle += steps-cycles
+                cycles = steps
+                break
+            else:
+                idle += 1
             self.step()
-        return self.log
+            cycles += 1
+        return cycles
 
-    def __init__(self,N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS):
+    # Runs for a given number of steps, returning the recorded signals
+    # If steps is None, runs until all vectors have been processed and returns the number of cycles it took
+    def run(self,steps=50):
+        # The fast engine does not step through the circuit
+        if self.ENGINE=='fast':
+            cycles = self.fastRun()
+        else:
+            cycles = self.cycleRun(steps)
+        self.log.record(self.cycle,end_of_run=True)
+        return self.log if steps is not None else cycles
+
+    def __init__(self,N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,ENGINE='cycle',DATA_TYPE='float',DATA_WIDTH=32):
         ''' Verifying parameters '''
         assert math.log(N, 2).is_integer(), "N must be a power of 2" 
         assert math.log(M, 2).is_integer(), "N must be a power of 2" 
         assert M<=N, "M must be less or equal to N" 
+        assert ENGINE in ['cycle','fast'], "ENGINE must be either 'cycle' or 'fast'"
+
+        # Emulation engine ('cycle' steps through every cycle, while 'fast' processes batches of vectors)
+        self.ENGINE=ENGINE
+
+        # Values are either floats, or DATA_WIDTH-bit words processed exactly like in the hardware
+        # Vectors and memory initializations are encoded when pushed, and the trace buffer holds encoded words
+        self.DATA_TYPE=DATA_TYPE
+        self.DATA_WIDTH=DATA_WIDTH
+        self.arith=arithmetic(DATA_TYPE,DATA_WIDTH)
 
         # hardware building blocks   
         self.BUILDING_BLOCKS=BUILDING_BLOCKS
+        self.PIPELINE_DEPTH=sum(BLOCK_LATENCY.get(b,0) for b in BUILDING_BLOCKS)
+        self.MAX_CHAINS=MAX_CHAINS
+        self.ib   = self.InputBuffer(N,IB_DEPTH,self.arith)
+        self.fu   = self.FilterUnit(N,M,FUVRF_SIZE,self.arith)
+        self.mvru = self.MatrixVectorReduce(N,M,self.arith)
+        self.vsru = self.VectorScalarReduce(N,self.arith)
+        self.vvalu= self.VectorVectorALU(N,VVVRF_SIZE,self.arith)
+        self.dp   = self.DataPacker(N,M,self.arith)
+        self.tb   = self.TraceBuffer(N,TB_SIZE,self.arith)
+        self.buildPipeline()
+        self.config()
+
+        # Firmware compiler
+        self.compiler = compiler(N,M,MAX_CHAINS,FUVRF_SIZE,VVVRF_SIZE)
+
+        # Signals recorded while running. By default, only the trace buffer at the end of each run is kept
+        self.cycle=0
+        self.in_flight=False
+        self.log=probeRecorder({'ib':self.ib,'fu':self.fu,'mvru':self.mvru,'vsru':self.vsru,'vvalu':self.vvalu,'dp':self.dp,'tb':self.tb})
+        self.probe(['tb'],depth=1,decimation=None)
+
+# Pipeline register of the stacked emulator, holding one vector (or matrix) and its flags for each of the K instances
+# Instances that have no vector in flight are not valid, and behave as if they were processing chain 0
+def stackedRegister(K,shape,dtype=float):
+    return struct(v=np.zeros((K,)+shape,dtype=dtype),eof=np.zeros((K,2),dtype=bool),bof=np.ones((K,2),dtype=bool),valid=np.zeros(K,dtype=bool),chainId=0)
+
+# Copy a pipeline register into another one in place (the vector is only copied if v is True)
+def latch(reg,value,v=True):
+    if v:
+        np.copyto(reg.v,value.v)
+    np.copyto(reg.eof,value.eof)
+    np.copyto(reg.bof,value.bof)
+    np.copyto(reg.valid,value.valid)
+    reg.chainId=value.chainId
+
+# Emulates K debuggers with the same parameters and firmware, each one with its own input stream
+# The state of all instances is stacked into arrays and all instances advance in the same step
+# Instances dispatch chains in lock step. When an instance has no vector, it idles while the others process theirs.
+# This changes when vectors are processed, but the trace buffer of each instance matches the one of emulatedHw
+class stackedEmulatedHw(emulatedHw):
+
+    class InputBuffer():
+        def __init__(self,K,N,IB_DEPTH,arith):
+            self.arith = arith
+            self.K = K
+            self.N = N
+            self.size=IB_DEPTH
+            self.capacity=IB_DEPTH+1
+            self.v=np.zeros((K,self.capacity,N),dtype=arith.dtype)
+            self.eof=np.zeros((K,self.capacity),dtype=np.uint8)
+            self.head=np.zeros(K,dtype=int)
+            self.count=np.zeros(K,dtype=int)
+            self.dropped=np.zeros(K,dtype=int)
+            self.config=None
+            self.chainId_out = 0
+            self.valid_out=np.zeros(K,dtype=bool)
+            self.bof_out=np.ones((K,2),dtype=bool)
+            self.out=stackedRegister(K,(N,),arith.dtype)
+
+        # Outputs are exposed with the same names as in emulatedHw so that they can be probed
+        @property
+        def v_out(self):
+            return self.out.v
+
+        def push(self,k,pushed_vals):
+            v_in, eof1, eof2 = (list(pushed_vals)+[False])[:3]
+            assert list(v_in.shape)==[self.N], "Input must be Nx1"
+            assert self.count[k]<self.capacity, "Input buffer overflowed"
+            tail=(self.head[k]+self.count[k])%self.capacity
+            self.v[k,tail]=self.arith.encode(v_in)
+            self.eof[k,tail]=bool(eof1)+2*bool(eof2)
+            self.count[k]+=1
+
+        # Push as many vectors of a TxN array as fit in the buffer of instance k, returning how many were pushed
+        def push_many(self,k,v_in,eof1,eof2):
+            assert v_in.ndim==2 and v_in.shape[1]==self.N, "Input must be TxN"
+            T=min(len(v_in),self.capacity-self.count[k])
+            tail=(self.head[k]+self.count[k]+np.arange(T))%self.capacity
+            self.v[k,tail]=self.arith.encode(v_in[:T])
+            self.eof[k,tail]=eof1[:T]+2*eof2[:T]
+            self.count[k]+=T
+            return T
+
+        # Push one vector to each instance (vectors is KxN)
+        def push_stacked(self,v_in,eof1,eof2):
+            assert list(v_in.shape)==[self.K,self.N], "Input must be KxN"
+            assert np.all(self.count<self.capacity), "Input buffer overflowed"
+            tail=(self.head+self.count)%self.capacity
+            self.v[np.arange(self.K),tail]=self.arith.encode(v_in)
+            self.eof[np.arange(self.K),tail]=eof1+2*eof2
+            self.count+=1
+
+        def step(self):
+            # Chains are dispatched in the same order as in emulatedHw, but all instances dispatch the same chain
+            num_chains=self.config.num_chains
+            if self.chainId_out==num_chains-1:
+                # Go to next element in the input buffer once we dispatched all chains for the previous element
+                popped=np.flatnonzero(self.valid_out)
+                self.bof_out[popped]=EOF_BITS[self.eof[popped,self.head[popped]]]
+                self.head[popped]=(self.head[popped]+1)%self.capacity
+                self.count[popped]-=1
+            if self.chainId_out==num_chains-1 or self.chainId_out==0:
+                self.valid_out=self.count>0
+                self.chainId_out = min(1,num_chains-1) if self.valid_out.any() else 0
+            else:
+                self.chainId_out=self.chainId_out+1
+
+            instances=np.arange(self.K)
+            self.out.v[:]=self.v[instances,self.head]
+            self.out.eof[:]=EOF_BITS[self.eof[instances,self.head]]
+            np.copyto(self.out.bof,self.bof_out)
+            np.copyto(self.out.valid,self.valid_out)
+            self.out.chainId=self.chainId_out
+            return self.out
+
+    class FilterUnit():
+        def __init__(self,K,N,M,FUVRF_SIZE,arith):
+            self.arith = arith
+            self.K = K
+            self.M = M
+            self.N = N
+            self.input=stackedRegister(K,(N,),arith.dtype)
+            self.out=stackedRegister(K,(M,N),arith.dtype)
+            self.config=None
+            self.kernels=None
+            self.vrf=np.zeros(FUVRF_SIZE*M)
+
+        @property
+        def m_out(self):
+            return self.out.v
+
+        @property
+        def vrf(self):
+            return self._vrf
+
+        # The same VRF can be given to all instances, or one VRF per instance (K rows)
+        @vrf.setter
+        def vrf(self,vals):
+            self._vrf=np.array(np.broadcast_to(np.asarray(vals,dtype=float),(self.K,np.shape(vals)[-1])))
+            self.loadEdges()
+
+        # Same table of bin edges as emulatedHw, with one table per instance
+        def loadEdges(self):
+            vrf = self.arith.encode(self._vrf)
+            num_addr = vrf.shape[1]//self.M
+            self.edges = np.empty((self.K,num_addr,self.M+1),dtype=vrf.dtype)
+            self.edges[:,:,:self.M] = vrf[:,:num_addr*self.M].reshape(self.K,num_addr,self.M)
+            self.edges[:,:,self.M] = [self.arith.lastEdges(instance_vrf,self.M) for instance_vrf in vrf]
+            # Sorted edges shared by all instances are searched instead of compared against every range
+            self.searchable = np.all(self.edges==self.edges[:1],axis=(0,2)) & np.all(self.edges[0,:,1:]>=self.edges[0,:,:-1],axis=1)
+
+        @staticmethod
+        def kernel(cfg,c):
+            addr=cfg.addr[c]
+            if cfg.filter[c]==1:
+                def run(fu):
+                    if fu.searchable[addr]:
+                        within_range = np.searchsorted(fu.edges[0,addr],fu.input.v,side='left')-1
+                        np.equal(within_range[:,None,:],np.arange(fu.M)[:,None],out=fu.out.v)
+                    else:
+                        edges=fu.edges[:,addr]
+                        v=fu.input.v[:,None,:]
+                        np.logical_and(v>edges[:,:-1,None],v<=edges[:,1:,None],out=fu.out.v)
+                    if fu.arith.ONE!=1:
+                        fu.out.v *= fu.arith.ONE
+            else:
+                def run(fu):
+                    fu.out.v[:,0] = fu.input.v
+                    fu.out.v[:,1:] = 0
+            return run
+
+        def step(self,input_value):
+            self.kernels[self.input.chainId](self)
+            latch(self.out,self.input,v=False)
+            latch(self.input,input_value)
+            return self.out
+
+    class MatrixVectorReduce():
+        def __init__(self,K,N,M,arith):
+            self.arith = arith
+            self.N = N
+            self.M = M
+            self.input=stackedRegister(K,(M,N),arith.dtype)
+            self.out=stackedRegister(K,(N,),arith.dtype)
+            self.config=None
+            self.kernels=None
+
+        @property
+        def v_out(self):
+            return self.out.v
+
+        @staticmethod
+        def kernel(cfg,c):
+            axis=cfg.axis[c]
+            if axis==0:
+                def run(mvru):
+                    np.copyto(mvru.out.v,mvru.input.v[:,0])
+            elif axis==1:
+                def run(mvru):
+                    mvru.arith.sum(mvru.input.v,axis=1,out=mvru.out.v)
+            elif axis==2:
+                def run(mvru):
+                    mvru.arith.sum(mvru.input.v,axis=2,out=mvru.out.v[:,:mvru.M])
+                    mvru.out.v[:,mvru.M:]=0
+            return run
+
+        def step(self,input_value):
+            self.kernels[self.input.chainId](self)
+            latch(self.out,self.input,v=False)
+            latch(self.input,input_value)
+            return self.out
+
+    class VectorScalarReduce():
+        def __init__(self,K,N,arith):
+            self.arith = arith
+            self.N = N
+            self.input=stackedRegister(K,(N,),arith.dtype)
+            self.out=stackedRegister(K,(N,),arith.dtype)
+            self.config=None
+            self.kernels=None
+
+        @property
+        def v_out(self):
+            return self.out.v
+
+        @staticmethod
+        def kernel(cfg,c):
+            if cfg.op[c]==0:
+                def run(vsru):
+                    np.copyto(vsru.out.v,vsru.input.v)
+            elif cfg.op[c]==1:
+                def run(vsru):
+                    vsru.arith.sum(vsru.input.v,axis=1,out=vsru.out.v[:,0])
+                    vsru.out.v[:,1:]=0
+            return run
+
+        def step(self,input_value):
+            self.kernels[self.input.chainId](self)
+            latch(self.out,self.input,v=False)
+            latch(self.input,input_value)
+            return self.out
+
+    class VectorVectorALU():
+        def __init__(self,K,N,VVVRF_SIZE,arith):
+            self.arith = arith
+            self.K = K
+            self.N = N
+            self.input=stackedRegister(K,(N,),arith.dtype)
+            self.out=stackedRegister(K,(N,),arith.dtype)
+            self.out_d1=stackedRegister(K,(N,),arith.dtype)
+            self.out_d2=stackedRegister(K,(N,),arith.dtype)
+            self.vrf=np.zeros(N*VVVRF_SIZE)
+            self.minicache=np.zeros((K,N),dtype=arith.dtype)
+            self.config=None
+            self.kernels=None
+
+        @property
+        def v_out(self):
+            return self.out.v
+
+        @property
+        def vrf(self):
+            return self._vrf
+
+        # The same VRF can be given to all instances, or one VRF per instance (K rows)
+        @vrf.setter
+        def vrf(self,vals):
+            self._vrf=np.array(np.broadcast_to(self.arith.encode(vals),(self.K,np.shape(vals)[-1])))
+            self.rows=self._vrf.reshape(self.K,-1,self.N)
+
+        @staticmethod
+        def kernel(cfg,c):
+            op, addr, cond = cfg.op[c], cfg.addr[c], cfg.cond[c]
+            cache, cache_addr, cache_cond = cfg.cache[c], cfg.cache_addr[c], cfg.cache_cond[c]
+            load, save = cfg.minicache[c] in [1,3], cfg.minicache[c] in [2,3]
+            def run(vvalu):
+                x, result = vvalu.input, vvalu.out_d1.v
+                operator = vvalu.minicache if load else x.v
+                if op!=0:
+                    vvalu.arith.ALU[op](operator,vvalu.rows[:,addr],out=result)
+                    # Values are passed through in instances where the condition is not met
+                    np.copyto(result,operator,where=~batchCondition(cond,x.eof,x.bof)[:,None])
+                else:
+                    np.copyto(result,operator)
+                # Only valid instances modify the state of the ALU
+                if cache:
+                    cached=x.valid & batchCondition(cache_cond,x.eof,x.bof)
+                    vvalu.rows[cached,cache_addr]=result[cached]
+                if save:
+                    np.copyto(vvalu.minicache,result,where=x.valid[:,None])
+            return run
+
+        def step(self,input_value):
+            # Delay for 2 cycles, so this FU takes 3 cycles (read, calculate, write)
+            self.out, self.out_d2, self.out_d1 = self.out_d2, self.out_d1, self.out
+            self.kernels[self.input.chainId](self)
+            latch(self.out_d1,self.input,v=False)
+            latch(self.input,input_value)
+            return self.out
+
+    class DataPacker():
+        def __init__(self,K,N,M,arith):
+            self.N = N
+            self.arith = arith
+            self.input=stackedRegister(K,(N,),arith.dtype)
+            self.v_out=np.zeros((K,N),dtype=arith.dtype)
+            self.v_out_valid=np.zeros(K,dtype=bool)
+            self.v_out_size=np.zeros(K,dtype=int)
+            self.config=None
+            self.kernels=None
+
+        @staticmethod
+        def kernel(cfg,c):
+            commit, size, cond = cfg.commit[c], cfg.size[c], cfg.cond[c]
+            half = cfg.precision[c]==1
+            words = size//2 if half else size
+            def run(dp):
+                dp.v_out_valid[:]=False
+                if not commit:
+                    return
+                x=dp.input
+                k=np.flatnonzero(x.valid & batchCondition(cond,x.eof,x.bof))
+                if len(k)==0:
+                    return
+                v_in = dp.arith.pack(x.v[k,:size]) if half else x.v[k,:size]
+                # Values that do not fit in N are dropped, since an overflowed packer never pushes again
+                position=dp.v_out_size[k,None]+np.arange(words)
+                fits=position<dp.N
+                dp.v_out[np.broadcast_to(k[:,None],position.shape)[fits],position[fits]]=v_in[fits]
+                dp.v_out_size[k]+=words
+                full=k[dp.v_out_size[k]==dp.N]
+                dp.v_out_valid[full]=True
+                dp.v_out_size[full]=0
+            return run
+
+        def step(self,input_value):
+            self.kernels[self.input.chainId](self)
+            latch(self.input,input_value)
+            return self.v_out, self.v_out_valid
+
+    class TraceBuffer():
+        def __init__(self,K,N,TB_SIZE,arith):
+            self.mem=np.zeros((K,TB_SIZE,N),dtype=arith.dtype)
+            self.size=np.zeros(K,dtype=int)
+            self.TB_SIZE=TB_SIZE
+
+        def step(self,packed_data,cycle):
+            output, output_valid = packed_data
+            k=np.flatnonzero(output_valid)
+            if len(k)>0:
+                addr=self.size[k]
+                addr[addr==self.TB_SIZE]=0
+                self.mem[k,addr]=output[k]
+                self.size[k]=addr+1
+
+    # Chains other than chain 0 that are still being processed by any instance
+    def busy(self):
+        registers=[self.fu.input,self.mvru.input,self.vsru.input,self.vvalu.input,self.vvalu.out_d1,self.vvalu.out_d2,self.dp.input]
+        return self.ib.count.any() or any(r.chainId!=0 and r.valid.any() for r in registers)
+
+    # Trace buffers of the instances are only kept in memory (see stream in emulatedHw)
+    def stream(self,sink=None):
+        assert sink is None, "stackedEmulatedHw cannot stream trace buffers. Use one emulatedHw per stream instead"
+
+    # Pushes values to the input of instance k
+    def push(self,k,pushed_vals):
+        self.ib.push(k,pushed_vals)
+
+    # Pushes a TxN array (or an iterable of vectors) to instance k (see emulatedHw.push_many)
+    def push_many(self,k,vectors,eof1=None,eof2=None,backpressure='block'):
+        dropped = self.pushStream(lambda v, e1, e2: self.ib.push_many(k,v,e1,e2),vectors,eof1,eof2,backpressure)
+        self.ib.dropped[k] += dropped
+        return dropped
+
+    # Pushes one vector to each instance (vectors is KxN, eof1 and eof2 have K elements)
+    def push_stacked(self,vectors,eof1=None,eof2=None):
+        eof1 = np.zeros(self.K,dtype=bool) if eof1 is None else np.asarray(eof1,dtype=bool)
+        eof2 = np.zeros(self.K,dtype=bool) if eof2 is None else np.asarray(eof2,dtype=bool)
+        self.ib.push_stacked(vectors,eof1,eof2)
+
+    def __init__(self,K,N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE='float',DATA_WIDTH=32):
+        ''' Verifying parameters '''
+        assert math.log(N, 2).is_integer(), "N must be a power of 2" 
+        assert math.log(M, 2).is_integer(), "N must be a power of 2" 
+        assert M<=N, "M must be less or equal to N" 
+        assert K>0, "K must be positive"
+
+        # Instances are always emulated cycle by cycle
+        self.K=K
+        self.ENGINE='cycle'
+
+        # Values are either floats or DATA_WIDTH-bit words, like in emulatedHw
+        self.DATA_TYPE=DATA_TYPE
+        self.DATA_WIDTH=DATA_WIDTH
+        self.arith=arithmetic(DATA_TYPE,DATA_WIDTH)
+
+        # hardware building blocks (one of each, holding the state of all instances)
+        self.BUILDING_BLOCKS=BUILDING_BLOCKS
+        self.PIPELINE_DEPTH=sum(BLOCK_LATENCY.get(b,0) for b in BUILDING_BLOCKS)
         self.MAX_CHAINS=MAX_CHAINS
-        self.ib   = self.InputBuffer(N,IB_DEPTH)
-        self.fu   = self.FilterUnit(N,M,FUVRF_SIZE)
-        self.mvru = self.MatrixVectorReduce(N,M)
-        self.vsru = self.VectorScalarReduce(N)
-        self.vvalu= self.VectorVectorALU(N,VVVRF_SIZE)
-        self.dp   = self.DataPacker(N,M)
-        self.tb   = self.TraceBuffer(N,TB_SIZE)
+        self.ib   = self.InputBuffer(K,N,IB_DEPTH,self.arith)
+        self.fu   = self.FilterUnit(K,N,M,FUVRF_SIZE,self.arith)
+        self.mvru = self.MatrixVectorReduce(K,N,M,self.arith)
+        self.vsru = self.VectorScalarReduce(K,N,self.arith)
+        self.vvalu= self.VectorVectorALU(K,N,VVVRF_SIZE,self.arith)
+        self.dp   = self.DataPacker(K,N,M,self.arith)
+        self.tb   = self.TraceBuffer(K,N,TB_SIZE,self.arith)
+        self.buildPipeline()
         self.config()
 
         # Firmware compiler
-        self.compiler = compiler(N,M,MAX_CHAINS)
+        self.compiler = compiler(N,M,MAX_CHAINS,FUVRF_SIZE,VVVRF_SIZE)
+
+        # Signals recorded while running (each sample holds the signal of all instances)
+        self.cycle=0
+        self.in_flight=False
+        self.log=probeRecorder({'ib':self.ib,'fu':self.fu,'mvru':self.mvru,'vsru':self.vsru,'vvalu':self.vvalu,'dp':self.dp,'tb':self.tb})
+        self.probe(['tb'],depth=1,decimation=None)
+
+# Shared memory array. A new block is allocated unless the name of an existing one is given
+def sharedArray(shape,dtype,name=None):
+    size = max(1,int(np.prod(shape))*np.dtype(dtype).itemsize)
+    shm = shared_memory.SharedMemory(name=name,create=name is None,size=size)
+    return shm, np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+
+# Emulates one shard in a worker process. Vectors are read from and trace buffers written to shared memory
+def emulateShard(params,hw,shared,shard,begin,end):
+    shms = [shared_memory.SharedMemory(name=name) for name, _, _ in shared]
+    try:
+        return emulateStream(params,hw,[np.ndarray(shape,dtype=dtype,buffer=shm.buf) for shm, (_, shape, dtype) in zip(shms,shared)],shard,begin,end)
+    finally:
+        for shm in shms:
+            shm.close()
+
+def emulateStream(params,hw,arrays,shard,begin,end):
+    v_in, eof, tb, stats = arrays
+    proc = emulatedHw(*params)
+    if hw.fu_vrf is not None:
+        proc.fu.vrf=hw.fu_vrf
+    if hw.vvalu_vrf is not None:
+        proc.vvalu.vrf=hw.vvalu_vrf
+    proc.config(hw.fw)
+    proc.push_many(v_in[begin:end],eof[begin:end,0],eof[begin:end,1])
+    proc.run(steps=None)
+    tb[shard] = proc.tb.mem
+    stats[shard] = [proc.tb.size,proc.tb.count,proc.cycle]
+
+# Emulates independent input streams (e.g. one per layer) in parallel, each one on its own emulatedHw in a worker process
+# Every stream starts from a freshly configured emulator, so streams must not depend on each other
+class shardedEmulatedHw():
+
+    # Firmware and memory initializations given to the emulator of each shard
+    def config(self,fw=None):
+        self.hw.fw=fw
+
+    def initialize_fu(self,vals):
+        self.hw.fu_vrf=vals
+
+    def initialize_vvalu(self,vals):
+        self.hw.vvalu_vrf=vals
+
+    # Adds a stream of TxN vectors with optional eof flags of length T as a new shard
+    def push_many(self,vectors,eof1=None,eof2=None):
+        vectors = np.asarray(vectors,dtype=float)
+        T = len(vectors)
+        eof1 = np.zeros(T,dtype=bool) if eof1 is None else np.asarray(eof1,dtype=bool)
+        eof2 = np.zeros(T,dtype=bool) if eof2 is None else np.asarray(eof2,dtype=bool)
+        assert vectors.shape==(T,self.N), "vectors must be a TxN array"
+        assert len(eof1)==T and len(eof2)==T, "eof flags must have one value per vector"
+        self.streams.append((vectors,np.stack((eof1,eof2),axis=1)))
+
+    # Splits a stream into one shard per eof2 epoch
+    # This matches emulating the whole stream only if the firmware does not carry state across epochs
+    def push_epochs(self,vectors,eof1=None,eof2=None):
+        vectors = np.asarray(vectors,dtype=float)
+        T = len(vectors)
+        eof1 = np.zeros(T,dtype=bool) if eof1 is None else np.asarray(eof1,dtype=bool)
+        eof2 = np.zeros(T,dtype=bool) if eof2 is None else np.asarray(eof2,dtype=bool)
+        ends = np.flatnonzero(eof2)+1
+        for begin, end in zip(np.concatenate(([0],ends)),np.concatenate((ends,[T]))):
+            if end>begin:
+                self.push_many(vectors[begin:end],eof1[begin:end],eof2[begin:end])
+
+    # Emulates all shards until they are drained, returning their trace buffers (SxTB_SIZExN) in the order they were pushed
+    def run(self):
+        S = len(self.streams)
+        N, TB_SIZE = self.N, self.TB_SIZE
+        T = sum(len(v) for v, _ in self.streams)
+        offsets = np.cumsum([0]+[len(v) for v, _ in self.streams])
+
+        # Inputs and results go through shared memory instead of being pickled
+        arrays = [sharedArray((T,N),float),sharedArray((T,2),bool),sharedArray((S,TB_SIZE,N),self.arith.dtype),sharedArray((S,3),np.int64)]
+        shms = [shm for shm, _ in arrays]
+        try:
+            v_in, eof, tb, stats = [a for _, a in arrays]
+            for (v, e), begin, end in zip(self.streams,offsets[:-1],offsets[1:]):
+                v_in[begin:end], eof[begin:end] = v, e
+            shared = [(shm.name,a.shape,a.dtype.str) for shm, a in arrays]
+
+            # Forking avoids importing the caller's script again in each worker
+            context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+            with ProcessPoolExecutor(max_workers=min(self.WORKERS,max(1,S)),mp_context=context) as pool:
+                jobs = [pool.submit(emulateShard,self.params,self.hw,shared,s,offsets[s],offsets[s+1]) for s in range(S)]
+                for job in jobs:
+                    job.result()
+
+            self.tb = np.array(tb)
+            self.size, self.count, self.cycles = [np.array(x) for x in np.array(stats).T]
+            del v_in, eof, tb, stats, arrays
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+        self.streams = []
+        return self.tb
+
+    # Vectors kept by the trace buffers of all shards, from the oldest to the newest, with shards in the order they were pushed
+    def trace(self):
+        words = [tb[:size] if count<=self.TB_SIZE else np.concatenate((tb[size:],tb[:size])) for tb, size, count in zip(self.tb,self.size,self.count)]
+        return np.concatenate([np.zeros((0,self.N),dtype=self.arith.dtype)]+words)
+
+    def __init__(self,N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,ENGINE='fast',WORKERS=None,DATA_TYPE='float',DATA_WIDTH=32):
+        assert ENGINE in ['cycle','fast'], "ENGINE must be either 'cycle' or 'fast'"
+        self.N, self.TB_SIZE = N, TB_SIZE
+        self.params = (N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,ENGINE,DATA_TYPE,DATA_WIDTH)
+        self.arith = arithmetic(DATA_TYPE,DATA_WIDTH)
+
+        # Number of worker processes (one per core by default)
+        self.WORKERS = os.cpu_count() if WORKERS is None else WORKERS
+
+        # Firmware compiler
+        self.compiler = compiler(N,M,MAX_CHAINS,FUVRF_SIZE,VVVRF_SIZE)
 
-        # used to simulate a trace buffer to match results with simulation
-        self.log={k: [] for k in ['ib','fu','mvru','vsru','vvalu','dp','tb']}
+        self.hw = struct(fw=None,fu_vrf=None,vvalu_vrf=None)
+        self.streams = []
+        self.tb = np.zeros((0,TB_SIZE,N),dtype=self.arith.dtype)
+        self.size = self.count = self.cycles = np.zeros(0,dtype=np.int64)
@@ -1,4 +1,121 @@
 from misc.misc import *
+import numpy as np
+import math, itertools, functools
+from collections import namedtuple
+
+# Conditions are encoded as bitmasks using the same bits as the hardware (condition2 is shifted by 4 bits)
+CONDITION_BITS={'last':1,'notlast':2,'first':4,'notfirst':8}
+
+# Flat firmware table with one row per chain and one field per opcode
+FIRMWARE_TABLE=np.dtype([('fu_filter','u1'),('fu_addr','i4'),
+                         ('mvru_axis','u1'),
+                         ('vsru_op','u1'),
+                         ('vvalu_op','u1'),('vvalu_addr','i4'),('vvalu_cond','u1'),('vvalu_cache','u1'),
+                         ('vvalu_cache_addr','i4'),('vvalu_minicache','u1'),('vvalu_cache_cond','u1'),
+                         ('dp_commit','u1'),('dp_size','i4'),('dp_cond','u1'),('dp_precision','u1')])
+
+# Configuration of each building block for a single chain
+# Records are immutable, so chains can share them (e.g. all empty chains share EMPTY_CHAIN)
+condition  = namedtuple('condition',['last','notlast','first','notfirst'])
+fuChain    = namedtuple('fuChain',['filter','addr'])
+mvruChain  = namedtuple('mvruChain',['axis'])
+vsruChain  = namedtuple('vsruChain',['op'])
+vvaluChain = namedtuple('vvaluChain',['op','addr','cond1','cond2','cache','cache_addr','minicache','cache_cond1','cache_cond2'])
+dpChain    = namedtuple('dpChain',['commit','size','cond1','cond2','precision'])
+NO_CONDITION=condition(False,False,False,False)
+EMPTY_CHAIN={'fu':fuChain(0,0),'mvru':mvruChain(0),'vsru':vsruChain(0),
+             'vvalu':vvaluChain(0,0,NO_CONDITION,NO_CONDITION,0,0,0,NO_CONDITION,NO_CONDITION),
+             'dp':dpChain(0,0,NO_CONDITION,NO_CONDITION,'full')}
+
+# Compiled firmware, keyed by the firmware function, its arguments and the parameters of the compiler (see memoize)
+# Only the most recently used firmware is kept, so that parameter sweeps do not keep every compiled firmware alive
+# Call FIRMWARE_CACHE.clear() to release all of it
+FIRMWARE_CACHE=lruCache(256)
+
+# Number of cycles a chain takes to go through the registers of each building block
+BLOCK_LATENCY={'InputBuffer':0,'FilterReduceUnit':2,'VectorVectorALU':3,'VectorScalarReduce':1,'DataPacker':1,'TraceBuffer':0}
+
+# Conditions are immutable, so their encodings are cached
+@functools.lru_cache(maxsize=None)
+def encodeCondition(cond1,cond2):
+    mask=0
+    for name, bit in CONDITION_BITS.items():
+        if getattr(cond1,name):
+            mask|=bit
+        if getattr(cond2,name):
+            mask|=bit<<4
+    return mask
+
+# Reuse the firmware compiled by a firmware function (e.g. distribution(cp,bins,M)) when it is called again with the same
+# arguments on a new compiler with the same parameters. Each call gets its own copy of the lists of chains.
+def memoize(firmware):
+    @functools.wraps(firmware)
+    def compiled(cp,*args,**kwargs):
+        key=(firmware,args,tuple(sorted(kwargs.items())),cp.N,cp.M,cp.MAX_CHAINS,cp.FUVRF_SIZE,cp.VVVRF_SIZE,cp.OPTIMIZE)
+        # Firmware can only be reused if the compiler had no chains and the arguments can be used as a key
+        try:
+            cached = cp.chains_created==0 and key in FIRMWARE_CACHE
+        except TypeError:
+            return firmware(cp,*args,**kwargs)
+        if not cached:
+            fw = firmware(cp,*args,**kwargs)
+            if cp.chains_created!=len(fw['fu']):
+                return fw
+            FIRMWARE_CACHE[key]=fw
+        fw = FIRMWARE_CACHE[key]
+        cp.firmware = {name:(list(value) if isinstance(value,list) else copy(value)) for name, value in fw.items()}
+        cp.chains_created = len(fw['fu'])
+        return cp.firmware
+    return compiled
+
+# Evaluate encoded conditions for a batch of vectors (eof and bof are Tx2 boolean arrays)
+# A condition is met if all of its bits are set in the status of the vector
+def batchCondition(cond,eof,bof):
+    if cond==0:
+        return np.ones(len(eof),dtype=bool)
+    status = np.where(eof[:,0],1,2) | np.where(bof[:,0],4,8) | np.where(eof[:,1],16,32) | np.where(bof[:,1],64,128)
+    return (cond & ~status)==0
+
+# Static analysis of a compiled firmware running on a given hardware
+# Epochs (eof[0]) have vectors_per_epoch vectors and frames (eof[1]) have epochs_per_frame epochs
+# Assumes that the committed values are packed into full words (values that overflow the data packer are not counted as lost)
+def analyze(fw,N,IB_DEPTH,TB_SIZE,BUILDING_BLOCKS,vectors_per_epoch,epochs_per_frame=1):
+    table = fw['table'][:fw['valid_chains']]
+
+    # The input buffer dispatches each vector once per chain
+    cycles_per_vector = max(1,len(table))
+    latency = {b:BLOCK_LATENCY[b] for b in BUILDING_BLOCKS}
+
+    # Count the values committed over a whole frame, with flags set like the input buffer does
+    T = vectors_per_epoch*epochs_per_frame
+    eof = np.zeros((T,2),dtype=bool)
+    eof[vectors_per_epoch-1::vectors_per_epoch,0] = True
+    eof[-1,1] = True
+    bof = np.roll(eof,1,axis=0)
+    values = 0
+    for chain in table[table['dp_commit']==1]:
+        size = int(chain['dp_size'])//2 if chain['dp_precision']==1 else int(chain['dp_size'])
+        values += int(batchCondition(chain['dp_cond'],eof,bof).sum())*size
+    words_per_epoch = values/(N*epochs_per_frame)
+    epochs_until_wrap = TB_SIZE/words_per_epoch if values>0 else math.inf
+
+    # A vector can arrive every cycles_per_vector cycles without filling the input buffer
+    # Back-to-back vectors (one per cycle) are accepted until the buffer, which also holds the vector being dispatched, is full
+    max_burst = math.inf
+    if cycles_per_vector>1:
+        max_burst = 1
+        while max_burst-(max_burst-1)//cycles_per_vector<IB_DEPTH+1:
+            max_burst += 1
+
+    return struct(chains=len(table),
+                  cycles_per_vector=cycles_per_vector,
+                  latency=latency,
+                  pipeline_depth=sum(latency.values()),
+                  words_per_epoch=words_per_epoch,
+                  epochs_until_wrap=epochs_until_wrap,
+                  cycles_until_wrap=epochs_until_wrap*vectors_per_epoch*cycles_per_vector,
+                  max_input_rate=1/cycles_per_vector,
+                  max_burst=max_burst)
 
 #Hardware configurations (that can be done by VLIW instruction)
 class compiler():
@@ -6,89 +123,249 @@ class compiler():
     def begin_chain(self):
         assert self.chains_created<self.MAX_CHAINS, "Firmware has more chains than the hardware can handle"
         self.chains_created+=1
-        no_cond={'last':False,'notlast':False,'first':False,'notfirst':False}
-        self.fu    = struct(filter=0,addr=0)
-        self.mvru  = struct(axis=0)
-        self.vsru  = struct(op=0)
-        self.vvalu = struct(op=0,addr=0,cond1=copy(no_cond),cond2=copy(no_cond),cache=0,cache_addr=0,minicache=0,cache_cond1=copy(no_cond),cache_cond2=copy(no_cond))
-        self.dp    = struct(commit=0,size=0,cond1=copy(no_cond),cond2=copy(no_cond),precision='full')
+        self.fu, self.mvru, self.vsru, self.vvalu, self.dp = (EMPTY_CHAIN[unit] for unit in ['fu','mvru','vsru','vvalu','dp'])
     def vv_filter(self,addr):
-        self.fu.filter=1
-        self.fu.addr=addr
+        self.fu=self.fu._replace(filter=1,addr=addr)
     def m_reduce(self,axis='N'):
         if axis=='N':
-            self.mvru.axis=1
+            self.mvru=self.mvru._replace(axis=1)
         elif axis=='M':
-            self.mvru.axis=2
+            self.mvru=self.mvru._replace(axis=2)
         else:
             assert False, "Unknown axis for instruction m_reduce"
     def v_reduce(self):
-        self.vsru.op=1
+        self.vsru=self.vsru._replace(op=1)
     def vv_add(self,addr,condition1=None, condition2=None):
-        self.vvalu.op=1
-        self.vvalu.addr=addr
-        self.vvalu.cond1[condition1]=self.__process_condition(condition1)
-        self.vvalu.cond2[condition2]=self.__process_condition(condition2)
+        self.__vv_op(1,addr,condition1,condition2)
     def vv_mul(self,addr,condition1=None, condition2=None):
-        self.vvalu.op=2
-        self.vvalu.addr=addr
-        self.vvalu.cond1[condition1]=self.__process_condition(condition1)
-        self.vvalu.cond2[condition2]=self.__process_condition(condition2)
+        self.__vv_op(2,addr,condition1,condition2)
     def vv_sub(self,addr,condition1=None, condition2=None):
-        self.vvalu.op=3
-        self.vvalu.addr=addr
-        self.vvalu.cond1[condition1]=self.__process_condition(condition1)
-        self.vvalu.cond2[condition2]=self.__process_condition(condition2)
+        self.__vv_op(3,addr,condition1,condition2)
     def vv_max(self,addr,condition1=None, condition2=None):
-        self.vvalu.op=4
-        self.vvalu.addr=addr
-        self.vvalu.cond1[condition1]=self.__process_condition(condition1)
-        self.vvalu.cond2[condition2]=self.__process_condition(condition2)
+        self.__vv_op(4,addr,condition1,condition2)
     def v_cache(self,cache_addr,condition1=None, condition2=None):
-        self.vvalu.cache=1
-        self.vvalu.cache_addr=cache_addr
-        self.vvalu.cache_cond1[condition1]=self.__process_condition(condition1)
-        self.vvalu.cache_cond2[condition2]=self.__process_condition(condition2)
+        self.vvalu=self.vvalu._replace(cache=1,cache_addr=cache_addr,
+                                       cache_cond1=self.__process_condition(self.vvalu.cache_cond1,condition1),
+                                       cache_cond2=self.__process_condition(self.vvalu.cache_cond2,condition2))
     def v_mc_load(self):
         if self.vvalu.minicache==0:
-            self.vvalu.minicache=1
+            self.vvalu=self.vvalu._replace(minicache=1)
         else:
             assert False, "Trying to save to load minicache more than once per chain or saving before loading"
     def v_mc_save(self):
         if self.vvalu.minicache==0 or self.vvalu.minicache==1:
-            self.vvalu.minicache+=2
+            self.vvalu=self.vvalu._replace(minicache=self.vvalu.minicache+2)
         else:
             assert False, "Trying to save to save minicache more than once per chain"
     # Modified to add functionality for full/half precision
     def v_commit(self,size=None,condition1=None, condition2=None, precision='full'):
         if size is None:
             size = self.N
-        self.dp.commit=1
-        if size==self.N or size==self.M or size==1:
-            self.dp.size=size
-        else:
+        if not (size==self.N or size==self.M or size==1):
             assert False, "Cannot commit "+str(size)+" elements"
-        self.dp.cond1[condition1]=self.__process_condition(condition1)
-        self.dp.cond2[condition2]=self.__process_condition(condition2)
-        self.dp.precision = self.__process_precision(precision)
+        self.dp=self.dp._replace(commit=1,size=size,
+                                 cond1=self.__process_condition(self.dp.cond1,condition1),
+                                 cond2=self.__process_condition(self.dp.cond2,condition2),
+                                 precision=self.__process_precision(precision))
+        # Values committed in half precision are packed in pairs
+        assert precision=='full' or size%2==0, "Half precision commits need an even number of elements"
     def end_chain(self):
-        self.firmware['fu'].append(copy(self.fu))
-        self.firmware['mvru'].append(copy(self.mvru))
-        self.firmware['vsru'].append(copy(self.vsru))
-        self.firmware['vvalu'].append(copy(self.vvalu))
-        self.firmware['dp'].append(copy(self.dp))
-    def compile(self):
-        # Make sure we are returning a firmware with MAX_CHAINS chains
+        self.firmware['fu'].append(self.fu)
+        self.firmware['mvru'].append(self.mvru)
+        self.firmware['vsru'].append(self.vsru)
+        self.firmware['vvalu'].append(self.vvalu)
+        self.firmware['dp'].append(self.dp)
+    # If optimize is set (or, when it is None, if the compiler was created with OPTIMIZE=True), chains are removed and merged
+    # without changing the results (see optimize). This changes chain ids and valid_chains, so it is off by default.
+    def compile(self,optimize=None):
+        if self.OPTIMIZE if optimize is None else optimize:
+            self.optimize()
+        else:
+            self.firmware['saved_cycles'] = 0
+        self.allocate()
+        # Make sure we are returning a firmware with MAX_CHAINS chains (padding chains share the same records)
         self.firmware['valid_chains'] = self.chains_created
-        while self.chains_created!=self.MAX_CHAINS:
-            self.begin_chain()
-            self.end_chain()
+        for unit in ['fu','mvru','vsru','vvalu','dp']:
+            self.firmware[unit].extend([EMPTY_CHAIN[unit]]*(self.MAX_CHAINS-self.chains_created))
+        self.chains_created = self.MAX_CHAINS
+        self.firmware['table'] = self.table()
         # Return final firmware    
         return self.firmware
 
-    def __process_condition(self,condition):
-        if condition=="last" or condition=="notlast" or condition=="first" or condition=="notfirst" or condition is None :
-            return True
+    # Every chain takes one cycle per input vector, so chains are removed when they have no effect and merged when possible
+    # Two chains are merged when they compute the same values and have effects in different units (e.g. one caches and the other commits)
+    # The merged chain takes the place of one of them, so the other one must not depend on the chains it moves across
+    def optimize(self):
+        units = ['fu','mvru','vsru','vvalu','dp']
+        chains = [{u:self.firmware[u][idx] for u in units} for idx in range(self.chains_created)]
+        chains = [c for c in chains if self.__effects(c)]
+        merged = True
+        while merged:
+            merged = False
+            for i, j in itertools.combinations(range(len(chains)),2):
+                first, second = chains[i], chains[j]
+                if self.__datapath(first)!=self.__datapath(second) or self.__effects(first) & self.__effects(second):
+                    continue
+                # Merged chains read before they write, so the second chain cannot read what the first one writes
+                reads, writes = self.__accesses(second)[0], self.__accesses(first)[1]
+                if reads & writes:
+                    continue
+                between = chains[i+1:j]
+                if self.__movable(second,between):
+                    chains[i] = self.__merge(first,second)
+                    chains.pop(j)
+                elif self.__movable(first,between):
+                    chains[j] = self.__merge(second,first)
+                    chains.pop(i)
+                else:
+                    continue
+                merged = True
+                break
+        self.firmware['saved_cycles'] = max(1,self.chains_created)-max(1,len(chains))
+        for u in units:
+            self.firmware[u] = [c[u] for c in chains]
+        self.chains_created = len(chains)
+
+    # Fields that set the values going through a chain (fields of disabled operations are ignored)
+    def __datapath(self,chain):
+        fu, mvru, vsru, vvalu = chain['fu'], chain['mvru'], chain['vsru'], chain['vvalu']
+        return (fu.filter, fu.addr if fu.filter else 0, mvru.axis, vsru.op, vvalu.op, vvalu.addr if vvalu.op else 0,
+                encodeCondition(vvalu.cond1,vvalu.cond2) if vvalu.op else 0, vvalu.minicache&1)
+
+    # Units in which a chain has an observable effect (VRF and minicache writes in the vvalu and commits in the dp)
+    def __effects(self,chain):
+        effects = set()
+        if chain['vvalu'].cache or chain['vvalu'].minicache&2:
+            effects.add('vvalu')
+        if chain['dp'].commit:
+            effects.add('dp')
+        return effects
+
+    # State read and written by a chain. Commits also count as writes, since the order of the committed values matters
+    def __accesses(self,chain):
+        vvalu = chain['vvalu']
+        reads, writes = set(), set()
+        if vvalu.op:
+            reads.add(('vrf',vvalu.addr))
+        if vvalu.minicache&1:
+            reads.add('minicache')
+        if vvalu.cache:
+            writes.add(('vrf',vvalu.cache_addr))
+        if vvalu.minicache&2:
+            writes.add('minicache')
+        if chain['dp'].commit:
+            writes.add('dp')
+        return reads, writes
+
+    # Check if a chain can be executed before or after other chains without changing the results
+    def __movable(self,chain,others):
+        reads, writes = self.__accesses(chain)
+        for other in others:
+            other_reads, other_writes = self.__accesses(other)
+            if writes & (other_reads | other_writes) or reads & other_writes:
+                return False
+        return True
+
+    # Add the effects of a chain to another chain that computes the same values
+    def __merge(self,chain,other):
+        merged = dict(chain)
+        if 'vvalu' in self.__effects(other):
+            vvalu = merged['vvalu']._replace(minicache=merged['vvalu'].minicache|other['vvalu'].minicache&2)
+            if other['vvalu'].cache:
+                vvalu = vvalu._replace(cache=other['vvalu'].cache,cache_addr=other['vvalu'].cache_addr,
+                                       cache_cond1=other['vvalu'].cache_cond1,cache_cond2=other['vvalu'].cache_cond2)
+            merged['vvalu'] = vvalu
+        if 'dp' in self.__effects(other):
+            merged['dp'] = other['dp']
+        return merged
+
+    # Replace named buffers (addresses given as strings) by addresses and check that all addresses fit in the VRFs
+    # Filter ranges are initialized by the user, so each named FU VRF buffer gets its own address
+    # A named VVVRF buffer that is first accessed by an unconditional v_cache only holds values while a vector goes through the chains,
+    # so it shares its address with buffers that are not in use at the same time. Other buffers keep their address for the whole run.
+    def allocate(self):
+        fu, vvalu = self.firmware['fu'], self.firmware['vvalu']
+
+        # Addresses given as numbers are reserved
+        fu_fixed = {c.addr for c in fu if c.filter and not isinstance(c.addr,str)}
+        fu_names = dict.fromkeys(c.addr for c in fu if c.filter and isinstance(c.addr,str))
+        free = (addr for addr in itertools.count() if addr not in fu_fixed)
+        fu_addresses = {name:next(free) for name in fu_names}
+
+        # Chains in which each named VVVRF buffer is first and last accessed (None if it keeps values across vectors)
+        # Conditional writes may keep the value of a previous vector, so they make the buffer live for the whole run
+        vvalu_fixed, spans = set(), {}
+        for idx, c in enumerate(vvalu):
+            if c.op:
+                if not isinstance(c.addr,str):
+                    vvalu_fixed.add(c.addr)
+                elif c.addr not in spans:
+                    spans[c.addr] = None
+                elif spans[c.addr] is not None:
+                    spans[c.addr][1] = idx
+            if c.cache:
+                if not isinstance(c.cache_addr,str):
+                    vvalu_fixed.add(c.cache_addr)
+                elif encodeCondition(c.cache_cond1,c.cache_cond2)!=0:
+                    spans[c.cache_addr] = None
+                elif c.cache_addr not in spans:
+                    spans[c.cache_addr] = [idx,idx]
+                elif spans[c.cache_addr] is not None:
+                    spans[c.cache_addr][1] = idx
+
+        # Buffers are placed in the first address in which they do not overlap with others, starting with the ones used the whole run
+        vvalu_addresses, placed = {}, {}
+        for name, span in sorted(spans.items(),key=lambda item: (item[1] is not None, item[1][0] if item[1] else 0)):
+            for addr in itertools.count():
+                others = placed.get(addr,[])
+                if addr in vvalu_fixed:
+                    continue
+                if span is None and len(others)==0:
+                    break
+                if span is not None and all(o is not None and (span[1]<=o[0] or o[1]<=span[0]) for o in others):
+                    break
+            placed.setdefault(addr,[]).append(span)
+            vvalu_addresses[name] = addr
+
+        for idx, c in enumerate(fu):
+            if c.filter and isinstance(c.addr,str):
+                fu[idx] = c._replace(addr=fu_addresses[c.addr])
+        for idx, c in enumerate(vvalu):
+            if c.op and isinstance(c.addr,str):
+                c = c._replace(addr=vvalu_addresses[c.addr])
+            if c.cache and isinstance(c.cache_addr,str):
+                c = c._replace(cache_addr=vvalu_addresses[c.cache_addr])
+            vvalu[idx] = c
+        self.firmware['addresses'] = {'fu':fu_addresses,'vvalu':vvalu_addresses}
+
+        # Check the capacity of the VRFs when it is known
+        fu_used = max([c.addr+1 for c in fu if c.filter],default=0)
+        vvalu_used = max([c.addr+1 for c in vvalu if c.op]+[c.cache_addr+1 for c in vvalu if c.cache],default=0)
+        assert self.FUVRF_SIZE is None or fu_used<=self.FUVRF_SIZE, f"Firmware needs {fu_used} FU VRF addresses, but the hardware only has {self.FUVRF_SIZE}"
+        assert self.VVVRF_SIZE is None or vvalu_used<=self.VVVRF_SIZE, f"Firmware needs {vvalu_used} VVVRF addresses, but the hardware only has {self.VVVRF_SIZE}"
+
+    # Flatten the chains into a structured array (used by the emulator)
+    def table(self):
+        rows = [(fu.filter, fu.addr,
+                 mvru.axis,
+                 vsru.op,
+                 vvalu.op, vvalu.addr, encodeCondition(vvalu.cond1,vvalu.cond2), vvalu.cache,
+                 vvalu.cache_addr, vvalu.minicache, encodeCondition(vvalu.cache_cond1,vvalu.cache_cond2),
+                 dp.commit, dp.size, encodeCondition(dp.cond1,dp.cond2), 1 if dp.precision=='half' else 0)
+                for fu, mvru, vsru, vvalu, dp in zip(*(self.firmware[unit] for unit in ['fu','mvru','vsru','vvalu','dp']))]
+        return np.array(rows,dtype=FIRMWARE_TABLE)
+
+    def __vv_op(self,op,addr,condition1,condition2):
+        self.vvalu=self.vvalu._replace(op=op,addr=addr,
+                                       cond1=self.__process_condition(self.vvalu.cond1,condition1),
+                                       cond2=self.__process_condition(self.vvalu.cond2,condition2))
+
+    # Add a condition to the ones already set
+    def __process_condition(self,cond,condition):
+        if condition=="last" or condition=="notlast" or condition=="first" or condition=="notfirst":
+            return cond._replace(**{condition:True})
+        elif condition is None:
+            return cond
         else:
             assert False, "Condition not understood"
 
@@ -99,10 +376,14 @@ class compiler():
         else:
             assert False, "Condition not understood"
 
-    def __init__(self,N,M,MAX_CHAINS):
+    # The sizes of the VRFs are only used to check the firmware, and are not checked if they are None
+    def __init__(self,N,M,MAX_CHAINS,FUVRF_SIZE=None,VVVRF_SIZE=None,OPTIMIZE=False):
         self.N = N
         self.M = M
         self.MAX_CHAINS=MAX_CHAINS
+        self.FUVRF_SIZE=FUVRF_SIZE
+        self.VVVRF_SIZE=VVVRF_SIZE
+        self.OPTIMIZE=OPTIMIZE
         self.fu, self.mvru, self.vsru, self.vvalu, self.dp = [],[],[],[],[]
         self.firmware ={"fu":[],"mvru":[],"vsru":[],"vvalu":[],"dp":[],"valid_chains":0}
         self.chains_created = 0
@@ -1,7 +1,11 @@
 # This files contains some of the different firmware that can be used by the HW and emulator
+# Firmware is memoized, so calling a function again with the same arguments and hardware parameters does not compile it again
+from firmware.compiler import memoize
 
 # Firmware for a distribution with multiple sets of N values
-def distribution(cp,bins,M):
+# Counts can be committed in half precision to fit twice as many bins in the trace buffer
+@memoize
+def distribution(cp,bins,M,precision='full'):
     assert bins%M==0, "Number of bins must be divisible by M for now"
     for i in range(int(bins/M)):
         cp.begin_chain()
@@ -9,11 +13,12 @@ def distribution(cp,bins,M):
         cp.m_reduce('M')
         cp.vv_add(i,'notfirst')
         cp.v_cache(i)
-        cp.v_commit(M,'last')
+        cp.v_commit(M,'last',precision=precision)
         cp.end_chain()
     return cp.compile()
 
 # Summary statistics - Number of non-sparse elements
+@memoize
 def summaryStats(cp):
     # Remember to properly initialize fu.vrf
 
@@ -37,6 +42,7 @@ def summaryStats(cp):
     return cp.compile()
 
 # Calculate spatial sparsity
+@memoize
 def spatialSparsity(cp,N):
     # Remember to properly initialize fu.vrf
     cp.begin_chain()
@@ -47,6 +53,7 @@ def spatialSparsity(cp,N):
     return cp.compile()
 
 # Check if previous vector changed
+@memoize
 def vectorChange(cp):
 
     # Commit difference between current and previous sample
@@ -63,6 +70,7 @@ def vectorChange(cp):
     return cp.compile()
 
 # Self correlation with the previous sample
+@memoize
 def correlation(cp):
 
     # sum(X*Y) [Assuming that Y is stored in addr0]
@@ -88,12 +96,14 @@ def correlation(cp):
     return cp.compile()
 
 # Check if previous vector changed
+@memoize
 def passThrough(cp):
     cp.begin_chain()
     cp.end_chain()
     return cp.compile()
 
 # Sum all input values
+@memoize
 def sumAll(cp):
     cp.begin_chain()
     cp.v_reduce()
@@ -102,6 +112,7 @@ def sumAll(cp):
     return cp.compile()
 
 # Raw values
+@memoize
 def raw(cp):
     cp.begin_chain()
     cp.v_commit()
@@ -109,6 +120,7 @@ def raw(cp):
     return cp.compile()
 
 # Simple test for vvalu
+@memoize
 def vvalu_simple(cp):
     cp.begin_chain()
     cp.vv_add(0)
@@ -118,6 +130,7 @@ def vvalu_simple(cp):
     return cp.compile()
 
 # Simple test for fru
+@memoize
 def fru_simple(cp):
     cp.begin_chain()
     cp.vv_filter(0)
@@ -127,6 +140,7 @@ def fru_simple(cp):
     return cp.compile()
 
 # Multiple Chains
+@memoize
 def multipleChains(cp):
     cp.begin_chain()
     cp.vv_filter(0)
@@ -145,6 +159,7 @@ def multipleChains(cp):
     return cp.compile()
 
 # Series of conditions for testing compiler
+@memoize
 def conditions(cp):
     cp.begin_chain()
     cp.v_commit()
@@ -163,6 +178,7 @@ def conditions(cp):
     return cp.compile()
 
 # Mini cache test
+@memoize
 def minicache(cp):
 
     cp.begin_chain()
@@ -185,6 +201,7 @@ def minicache(cp):
     return cp.compile()
 
 # Activation Predictiveness
+@memoize
 def activationPredictiveness(cp):
     # First we sum all activations of all nodes in address 0 (we will expect eof[0] to start a new sum)
     # Once we receive eof[0] we will check the max between this value and the one stored in the cache at address 1.
@@ -212,6 +229,7 @@ def activationPredictiveness(cp):
 # Norm Check
 # To get better results, use FRU_reconfig_vector to change FRU's filter values according to the range of the percentiles (currently done via UART as a proof-of-concept)
 # A single 64 bin distribution is used to get a proxy of the three percentiles, calculated offline.
+@memoize
 def normCheck(cp,M):
     bins=64
     assert bins%M==0, "Number of bins must be divisible by M"
@@ -8,6 +8,7 @@
   parameter M=2,
   parameter DATA_WIDTH=32,
   parameter MAX_CHAINS=4,
+  parameter DATA_TYPE=0,
   parameter PERSONAL_CONFIG_ID=0,
   parameter [7:0] INITIAL_FIRMWARE      [0:MAX_CHAINS-1] = '{MAX_CHAINS{0}},
   parameter [7:0] INITIAL_FIRMWARE_COND [0:MAX_CHAINS-1] = '{MAX_CHAINS{0}},
@@ -39,23 +40,39 @@
     reg cond_valid;
     wire [DATA_WIDTH-1:0] pack_1 [N-1:0];
     wire [DATA_WIDTH-1:0] pack_M [N-1:0];
+    wire [DATA_WIDTH-1:0] half_in [N-1:0];
+    wire [DATA_WIDTH-1:0] pack_half_N [N-1:0];
+    wire [DATA_WIDTH-1:0] pack_half_M [N-1:0];
     reg [7:0] byte_counter=0;
     enum {HALF, FULL} precision;
 
     //-------------Code Start-----------------
-// TODO: Needs a precision check; if precision == 1 (half). half precision would be 16. just configure data width to 16 ? but also changes output ?
+    // In half precision, pairs of values are packed into a single word (see half_in), so vector_length is halved
     always @(posedge clk) begin
       //Packing is not perfect, otherwise it would be too expensive
       // If we overflow, we just submit things as they are (This may happen if we are mixing precisions). TO actually halve vecotr length, 
       if (valid_in==1'b1 && tracing==1'b1 && commit==1'b1 && cond_valid==1'b1) begin
         if (total_length>N) begin 
             vector_out<=packed_data;
-            packed_data<=vector_in;
+            if (precision==HALF) begin
+              packed_data<=half_in;
+            end
+            else begin
+              packed_data<=vector_in;
+            end
             valid_out<=1;
             packed_counter<=vector_length;
         end
         else if (total_length==N) begin 
-            if (vector_length==1) begin
+            if (precision==HALF) begin
+              if (vector_length==N/2) begin
+                vector_out<=pack_half_N;
+              end
+              else begin
+                vector_out<=pack_half_M;
+              end
+            end
+            else if (vector_length==1) begin
               vector_out<=pack_1;
             end
             else if (vector_length==M) begin
@@ -70,7 +87,16 @@
         end
         else begin //no vector overflow
           valid_out<=0;
-          if (vector_length==1) begin
+          if (precision==HALF) begin
+            if (vector_length==N/2) begin
+              packed_data<=pack_half_N;
+            end
+            else begin
+              packed_data<=pack_half_M;
+            end
+            packed_counter<=total_length;
+          end
+          else if (vector_length==1) begin
             packed_data<=pack_1;
             packed_counter<=total_length;
           end
@@ -104,12 +130,21 @@
     end
 
     always @(*) begin
+      case (firmware_precision[chainId_in])
+        8'd0: precision = FULL;
+        8'd1: precision = HALF;
+        default: precision = FULL;
+      endcase
+
       case (firmware [chainId_in])
         8'd0:    begin vector_length = N; commit=1; end
         8'd1:    begin vector_length = M; commit=1; end
         8'd2:    begin vector_length = 1; commit=1; end
         default: begin vector_length = 0; commit=0; end
       endcase
+      if (precision==HALF) begin
+        vector_length = vector_length/2;
+      end
 
       // Only perform operation if condition is valid
       // none=0, last=1, notlast=2, first=3, notfirst=4
@@ -128,17 +163,33 @@
       else begin
         cond_valid = 1'b0;
       end
-
-      case (firmware_precision[chainId_in])
-        8'd0: precision = FULL;
-        8'd1: precision = HALF;
-        default: precision = FULL;
-      endcase
     end
 
     assign total_length = packed_counter+vector_length;
     assign pack_1 = {vector_in[0],packed_data[N-1:1]};
 
     assign pack_M = M==N ? {vector_in[M-1:0]}: {vector_in[M-1:0],packed_data[N-1+(M==N):M]};
+
+    // Pairs of values truncated to DATA_WIDTH/2 bits
+    // Integers keep their lower bits, while fixed-point values keep DATA_WIDTH/4 fractional bits
+    genvar g;
+    generate
+      for (g=0; g<N; g=g+1) begin : half_precision
+        if (g<N/2) begin
+          if (DATA_TYPE==0) begin
+            assign half_in[g] = {vector_in[2*g+1][DATA_WIDTH/2-1:0],vector_in[2*g][DATA_WIDTH/2-1:0]};
+          end
+          else begin
+            assign half_in[g] = {vector_in[2*g+1][3*DATA_WIDTH/4-1:DATA_WIDTH/4],vector_in[2*g][3*DATA_WIDTH/4-1:DATA_WIDTH/4]};
+          end
+        end
+        else begin
+          assign half_in[g] = {DATA_WIDTH{1'b0}};
+        end
+      end
+    endgenerate
+
+    assign pack_half_N = {half_in[N/2-1:0],packed_data[N-1:N/2]};
+    assign pack_half_M = M==1 ? pack_half_N : {half_in[M/2-1+(M==1):0],packed_data[N-1:M/2+(M==1)]};
  
  endmodule 
\ No newline at end of file
@@ -1,11 +1,11 @@
 import logging as log
-import sys, math, os, shutil, textwrap, subprocess,shlex
+import sys, math, os, shutil, textwrap, subprocess,shlex,hashlib,pickle
 from distutils.dir_util import copy_tree
 from shutil import copyfile
 from firmware.compiler import compiler
 from misc.misc import *
 import numpy as np
-from containers.modelsim.modelsimContainer import modelsimContainer
+from containers.modelsim.modelsimContainer import modelsimSession
 import time
 
 # Setting Debug level (can be debug, info, warning, error and critical)
@@ -482,6 +482,7 @@ class rtlHw():
             ['M'],
             ['DATA_WIDTH'],
             ['MAX_CHAINS'],
+            ['DATA_TYPE'],
             ['PERSONAL_CONFIG_ID'],
             ['INITIAL_FIRMWARE'],
             ['INITIAL_FIRMWARE_COND'],
@@ -540,21 +541,21 @@ class rtlHw():
                 else:
                     assert False
             def encodeCond(cond1,cond2):
-                if cond1['last']:
+                if cond1.last:
                     return 1
-                elif cond1['notlast']:
+                elif cond1.notlast:
                     return 2
-                elif cond1['first']:
+                elif cond1.first:
                     return 4
-                elif cond1['notfirst']:
+                elif cond1.notfirst:
                     return 8
-                elif cond2['last']:
+                elif cond2.last:
                     return 16
-                elif cond2['notlast']:
+                elif cond2.notlast:
                     return 32
-                elif cond2['first']:
+                elif cond2.first:
                     return 64
-                elif cond2['notfirst']:
+                elif cond2.notfirst:
                     return 128
                 else:
                     return 0
@@ -646,6 +647,7 @@ class rtlHw():
             ['DATA_WIDTH','DATA_WIDTH'],
             ['MAX_CHAINS','MAX_CHAINS'],
             ['PERSONAL_CONFIG_ID','4'],
+            ['DATA_TYPE','DATA_TYPE'],
             ['INITIAL_FIRMWARE',DP_INITIAL_FIRMWARE],
             ['INITIAL_FIRMWARE_COND',DP_INITIAL_FIRMWARE_COND],
             ['INITIAL_FIRMWARE_PRECISION',DP_INITIAL_FIRMWARE_PRECISION]])
@@ -704,55 +706,89 @@ class rtlHw():
         top.output_assignment={'vector_out': 'vector_out_tb','uart_txd':'uart_txd_comm'}
 
 
-    def testbench(self):
-        # Prepare testbench inputs
-        tb_inputs=[]
-        for i, inp in enumerate(self.testbench_inputs):
-            tb_inputs.append("valid = 1;")
-            tb_inputs.append(f"eof[0] = {int(inp[1])};")
-            if len(inp)>2:
-                tb_inputs.append(f"eof[1] = {int(inp[2])};")
-            else:
-                tb_inputs.append(f"eof[1] = 0;")
-            for idx,ele in enumerate(inp[0]):
-                tb_inputs.append(f"vector[{idx}]=32'd{ele};")
-            tb_inputs.append("#half_period;")
-            tb_inputs.append("#half_period;")
-            if i!=0:
-                tb_inputs.append("toFile();")  
-            tb_inputs.append("")
-        tb_inputs=("\n"+"    "*4).join(tb_inputs)
-
-        # Prepare testbench steps
-        tb_steps=[]
-        for i in range(self.steps-len(self.testbench_inputs)+1):
-            tb_steps.append("valid = 0;")
-            tb_steps.append("#half_period;")
-            tb_steps.append("#half_period;")
-            tb_steps.append("toFile();")
-            tb_steps.append("")
-        tb_steps=("\n"+"    "*4).join(tb_steps)
+    # Testbench inputs are read from stimulus.hex, so the testbench does not depend on the vectors pushed or on the number of steps
+    # Line t of the file holds the eof flags of vector t followed by its N values, all as DATA_WIDTH-bit hex words
+    def stimulus(self):
+        stimulus=np.zeros((len(self.testbench_inputs),self.N+1),dtype=np.uint64)
+        if len(self.testbench_inputs)>0:
+            stimulus[:,0]=[int(inp[1])|(int(inp[2])<<1 if len(inp)>2 else 0) for inp in self.testbench_inputs]
+            vectors=np.array([np.asarray(inp[0]) for inp in self.testbench_inputs])
+            stimulus[:,1:]=(vectors if vectors.dtype.kind=='u' else vectors.astype(np.int64)).astype(np.uint64)
+        return toHex(stimulus,self.DATA_WIDTH)
+
+    def writeStimulus(self,path):
+        with open(path,'wb') as f:
+            f.write(self.stimulus())
+
+    # Record only some outputs in the testbench, given as "instance" (all outputs of an instance) or "instance.output"
+    # Signals are only recorded from cycle window[0] up to (not including) window[1], and only on cycles where the 1-bit trigger output is set
+    # probe(None) records all outputs on every cycle again
+    def probe(self,signals,window=None,trigger=None):
+        assert window is None or window[0]<=window[1], "Probe window must end after it begins"
+        self.probes=struct(signals=None if signals is None else list(signals),window=window,trigger=trigger)
+
+    # Outputs of each instance recorded by the testbench
+    def probedSignals(self):
+        instances=self.top.inst.__dict__
+        if self.probes.trigger is not None:
+            inst_name, _, output = self.probes.trigger.partition('.')
+            assert inst_name in instances and output in [o.name for o in instances[inst_name].module_output], "Unknown trigger "+self.probes.trigger
+            assert [o.elements for o in instances[inst_name].module_output if o.name==output]==[1], "Trigger must have a single element"
+        if self.probes.signals is None:
+            return {name: list(inst.module_output) for name, inst in instances.items()}
+        probed={}
+        for signal in self.probes.signals:
+            inst_name, _, output = signal.partition('.')
+            assert inst_name in instances, "Unknown instance "+inst_name
+            outputs=[o for o in instances[inst_name].module_output if output in ('',o.name)]
+            assert outputs!=[], "Unknown output "+signal
+            probed.setdefault(inst_name,[])
+            probed[inst_name]+=[o for o in outputs if o not in probed[inst_name]]
+        return probed
 
+    def testbench(self):
         # Prepare testbench values to save to file
-        tb_store=[]
+        # Each record starts with the cycle it was written on, followed by the probed signals (all outputs of all instances by default)
+        # Values are written as unsigned 32-bit words (see resultsLayout), and values wider than 32 bits are split into two words, lower word first
+        def store(signal,bits):
+            if self.wordsPerValue(bits)==1:
+                return [f'$fwrite(write_data, "%u",{signal});']
+            return [f'$fwrite(write_data, "%u",{signal}[31:0]);',f'$fwrite(write_data, "%u",{signal}[DATA_WIDTH-1:32]);']
+        tb_store=store("cycle",32)
         tb_var_names={}
-        for i in self.top.inst.__dict__.keys():
-            inst=self.top.inst.__dict__[i]
-            tb_var_names[inst.name]=[]
-            for o in inst.module_output:
-                tb_var_names[inst.name].append([o.name,o.elements])
+        probed=self.probedSignals()
+        for inst_name, outputs in probed.items():
+            tb_var_names[inst_name]=[]
+            for o in outputs:
+                tb_var_names[inst_name].append([o.name,o.elements,o.bits])
                 if o.elements==1:
-                    tb_store.append(f'$fwrite(write_data, "%{"b" if o.bits==1 else "0d"} ",dbg.{inst.name}.{o.name});')
+                    tb_store+=store(f"dbg.{inst_name}.{o.name}",o.bits)
                 else:
                     if not o.elements.isnumeric():
-                        tb_store.append(f"for (i=0; i<dbg.{inst.name}.{o.elements}; i=i+1) begin")
+                        tb_store.append(f"for (i=0; i<dbg.{inst_name}.{o.elements}; i=i+1) begin")
                     else:
                         tb_store.append(f"for (i=0; i<{o.elements}; i=i+1) begin")
-                    tb_store.append(f'\t$fwrite(write_data, "%{"b" if o.bits==1 else "0d"} ",dbg.{inst.name}.{o.name}[i]);')
+                    tb_store+=["\t"+l for l in store(f"dbg.{inst_name}.{o.name}[i]",o.bits)]
                     tb_store.append("end")
-        tb_store.append('$fdisplay(write_data,"");')
+
+        # Only write records in the probed window of cycles, and on cycles where the trigger is set
+        condition=[]
+        if self.probes.window is not None:
+            condition.append(f"cycle>={self.probes.window[0]} && cycle<{self.probes.window[1]}")
+        if self.probes.trigger is not None:
+            condition.append(f"dbg.{self.probes.trigger}!=0")
+        if condition!=[]:
+            tb_store=[f"if ({' && '.join(condition)}) begin"]+["\t"+l for l in tb_store]+["end"]
+        tb_store.append("cycle=cycle+1;")
         tb_store=("\n"+"    "*4).join(tb_store)
 
+        # Trace buffer words are written in the same way, one record per address
+        if self.wordsPerValue('DATA_WIDTH')==1:
+            tb_mem_store='$fwrite(write_data2, "%u",tmp[DATA_WIDTH*j+:DATA_WIDTH]);'
+        else:
+            tb_mem_store=('$fwrite(write_data2, "%u",tmp[DATA_WIDTH*j+:32]);\n'+"    "*6+
+                          '$fwrite(write_data2, "%u",tmp[DATA_WIDTH*j+32+:DATA_WIDTH-32]);')
+
         # Add includes
         testbench='`include "debugProcessor.sv"\n'
 
@@ -778,6 +814,10 @@ class rtlHw():
             parameter FUVRF_SIZE={self.FUVRF_SIZE};
             parameter VVVRF_SIZE={self.VVVRF_SIZE};
             parameter DATA_TYPE={self.DATA_TYPE};
+
+            // Run-time parameters (set by vsim with -gVECTORS and -gSTEPS)
+            parameter VECTORS=0;
+            parameter STEPS=0;
    
             // Declare inputs
             reg clk=1'b0;
@@ -793,6 +833,7 @@ class rtlHw():
             reg valid_out;
 
             reg [DATA_WIDTH*N-1:0] tmp;
+            reg [DATA_WIDTH-1:0] stimulus [0:(N+1)*(VECTORS>0 ? VECTORS : 1)-1];
             integer count_1=0;
             integer count_2=0;
 
@@ -826,7 +867,8 @@ class rtlHw():
             );
 
             //Task to print all content to file
-            integer write_data,write_data2,i,j;
+            integer write_data,write_data2,i,j,t;
+            integer cycle=0;
             task toFile;
                 begin
                 {tb_store}
@@ -835,23 +877,40 @@ class rtlHw():
 
             // Test
             initial begin
-                write_data = $fopen("simulation_results.txt");
+                write_data = $fopen("simulation_results.bin","wb");
                 
+                $readmemh("stimulus.hex", stimulus);
+
                 $display("Test Started");
-                {tb_inputs}
-                
-                {tb_steps}
+                for (t=0; t<VECTORS; t=t+1) begin
+                    valid = 1;
+                    eof = stimulus[(N+1)*t][1:0];
+                    for (j=0; j<N; j=j+1) begin
+                        vector[j] = stimulus[(N+1)*t+1+j];
+                    end
+                    #half_period;
+                    #half_period;
+                    if (t!=0) begin
+                        toFile();
+                    end
+                end
+
+                for (t=0; t<STEPS-VECTORS+1; t=t+1) begin
+                    valid = 0;
+                    #half_period;
+                    #half_period;
+                    toFile();
+                end
                 
                 $fclose(write_data);
-                write_data2 = $fopen("simulation_results_tb.txt");
+                write_data2 = $fopen("simulation_results_tb.bin","wb");
                 for (i=0; i<dbg.tb.TB_SIZE; i=i+1) begin
                     tmp = dbg.tb.mem.{altsyncram_data_path}[i];
                     for (j=0; j<N; j=j+1) begin
                         // Verilog you can't have two variable expressions in a range, even if they evaluate to a constant difference.  
                         // Specifically: [j*DATA_WIDTH+DATA_WIDTH-1:j*DATA_WIDTH] should be:[j*DATA_WIDTH +: DATA_WIDTH]
-                        $fwrite(write_data2, "%0d ",tmp[DATA_WIDTH*j+:DATA_WIDTH]);
+                        {tb_mem_store}
                     end
-                    $fwrite(write_data2, "\\n");
                 end
                 $fclose(write_data2);
                 $finish;
@@ -877,7 +936,6 @@ class rtlHw():
             copyfile(self.hwFolder+"/buildingBlocks/device-specific/ram_dual_port_stratix10.sv", rtl_folder+"/ram_dual_port.sv")
         else:
             assert False, f"Currently only 'Cyclone V' and 'Stratix 10' are supported (received {self.DEVICE_FAM})"
-        copy_tree(self.hwFolder+"/simulationBlocks", rtl_folder)
 
         # Writes debugProcessor to file
         f = open(rtl_folder+"/debugProcessor.sv", "w")
@@ -896,64 +954,173 @@ class rtlHw():
         #Configure processor
         self.firmware=fw
 
+    # Hash of everything the results of run() depend on: parameters, firmware, memory initializations, stimulus, steps, probes and the RTL sources
+    def cacheKey(self):
+        digest=hashlib.sha1()
+        digest.update(repr([self.N,self.M,self.IB_DEPTH,self.FUVRF_SIZE,self.VVVRF_SIZE,self.TB_SIZE,self.DATA_WIDTH,self.MAX_CHAINS,
+                            self.BUILDING_BLOCKS,self.DATA_TYPE,self.DEVICE_FAM,self.steps,self.probes]).encode())
+
+        # Firmware chains are namedtuples, so their repr describes them completely
+        if self.firmware is not None:
+            digest.update(repr([self.firmware[unit] for unit in ['fu','mvru','vsru','vvalu','dp','valid_chains']]).encode())
+        for mod_name, mod in self.top.mod.__dict__.items():
+            for mem_name, m in mod.mem.items():
+                init_values=np.asarray(m['init_values']).tobytes() if m['init_values'] is not False else None
+                digest.update(repr([mod_name,mem_name,m['depth'],m['width'],m['packed_elements'],init_values]).encode())
+        digest.update(self.stimulus())
+
+        # Changes to the building blocks, the vendor simulation models or to this generator also change the results
+        sources=[os.path.realpath(__file__)]
+        for folder in ["/buildingBlocks","/simulationBlocks"]:
+            for root, _, files in sorted(os.walk(self.hwFolder+folder)):
+                sources+=[os.path.join(root,name) for name in sorted(files)]
+        for path in sources:
+            with open(path,'rb') as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
     # This will run the testbench of the generated hardware and return its results
-    def run(self,steps=50,gui=False,log=True):
-        # First, generate the RTL
+    # If a traceArchive is given, the words committed to the trace buffer during the simulation are appended to it
+    # If a modelsimSession is given, the simulation runs on its container, which is kept running after the simulation
+    # If a cache folder is given, the generated RTL and the results are stored in it, and a later run with the same cacheKey() reuses them
+    def run(self,steps=50,gui=False,log=True,archive=None,session=None,cache=None):
         self.steps=steps
+        entry=os.path.join(cache,self.cacheKey()) if cache is not None and not gui else None
+        if entry is not None and os.path.isdir(entry):
+            results=self.loadCache(entry)
+        else:
+            results=self.simulate(gui,log,session)
+            if entry is not None:
+                self.storeCache(entry,results)
+
+        if archive is not None:
+            self.archiveResults(results,archive)
+
+        return results
+
+    # Cache entries hold the generated RTL (without simulation outputs) and the parsed results
+    def storeCache(self,entry,results):
+        # Entries are written under a temporary name, so that an interrupted run does not leave a partial entry
+        tmp=f"{entry}.{os.getpid()}.tmp"
+        shutil.copytree(os.getcwd()+"/rtl",tmp+"/rtl",ignore=shutil.ignore_patterns('simulation_results*'))
+        with open(tmp+"/results.pkl","wb") as f:
+            pickle.dump([self.tb_var_names,results],f)
+        try:
+            os.rename(tmp,entry)
+        except OSError:
+            # Another run stored the same entry first
+            shutil.rmtree(tmp)
+
+    def loadCache(self,entry):
+        rtl_folder=os.getcwd()+"/rtl"
+        if os.path.isdir(rtl_folder):
+            shutil.rmtree(rtl_folder)
+        shutil.copytree(entry+"/rtl",rtl_folder)
+        with open(entry+"/results.pkl","rb") as f:
+            self.tb_var_names, results = pickle.load(f)
+        return results
+
+    # Generate the RTL, simulate it and parse the results
+    def simulate(self,gui,log,session):
+        # First, generate the RTL
         self.generateRtl()
+        self.writeStimulus(os.getcwd()+"/rtl/stimulus.hex")
 
         # Then, run simulation
         current_folder=os.getcwd()
         rtl_folder=current_folder+"/rtl/"
         os.chdir(rtl_folder)
 
-        modelsim = modelsimContainer(log)
+        modelsim = modelsimSession(log) if session is None else session
         modelsim.start()
-        modelsim.exec('mkdir rtl')
-        modelsim.copy(rtl_folder,'modelsim:.')
-        modelsim.exec('vlib work',working_directory='/rtl')
-        modelsim.exec('vlog altera_mf.v altera_lnsim.sv testbench.sv',working_directory='/rtl')
+        modelsim.sync(rtl_folder)
+        modelsim.library('work')
+        # Vendor models are compiled once into a library of the container, so only the debugger and testbench are compiled here
+        vendor=modelsim.vendorLibrary(self.hwFolder+"/simulationBlocks",['altera_mf.v','altera_lnsim.sv'],self.DEVICE_FAM)
+        exit_code, output = modelsim.check(f'vlog -L {vendor} testbench.sv',working_directory=modelsim.folder)
+        if log:
+            print(output)
+        assert exit_code==0, f"Failed to compile the testbench:\n{output}"
+
+        # Results of a previous simulation on the same session must not be mistaken for the results of this one
+        modelsim.check('rm -f simulation_results.bin simulation_results_tb.bin',working_directory=modelsim.folder)
+        vsim_args=f'-L {vendor} -gVECTORS={len(self.testbench_inputs)} -gSTEPS={self.steps}'
         if gui:
             print("Opening GUI\n\tMake sure to open socket using this command on your mac:\n\tsocat TCP-LISTEN:6000,reuseaddr,fork UNIX-CLIENT:\\\"$DISPLAY\\\"")
-            modelsim.exec('vsim -gui -do "run -all" testbench',working_directory='/rtl')
+            exit_code, output = modelsim.check(f'vsim -gui {vsim_args} -do "run -all" testbench',working_directory=modelsim.folder)
         else:
-            modelsim.exec('vsim -c -do "run -all" testbench',working_directory='/rtl')
-        modelsim.copy('modelsim:/rtl/simulation_results.txt','simulation_results.txt')
-        modelsim.copy('modelsim:/rtl/simulation_results_tb.txt','simulation_results_tb.txt')
-        modelsim.exec('rm -r rtl')
-        modelsim.stop()
+            exit_code, output = modelsim.check(f'vsim -c {vsim_args} -do "run -all" testbench',working_directory=modelsim.folder)
+        if log:
+            print(output)
+        assert exit_code==0, f"Simulation failed:\n{output}"
+        modelsim.fetch(['simulation_results.bin','simulation_results_tb.bin'],rtl_folder)
+        if session is None:
+            modelsim.stop()
 
         # Get results from file back to python
-        results={}
-        for mod in self.tb_var_names.keys():
-                results[mod]={}
-                for var_name, elements in self.tb_var_names[mod]:
-                    results[mod][var_name]=[]
-        f = open("simulation_results.txt", "r")
-        for line in f:
-            count=0
-            l= line.replace("\n","").split(" ")
-            for mod in self.tb_var_names.keys():
-                for var_name, elements in self.tb_var_names[mod]:
-                    if elements=='N':
-                        elements=self.N
-                    results[mod][var_name].append(l[count:count+elements])
-                    count=count+elements
-
-        f = open("simulation_results_tb.txt", "r")
-        tb=[]
-        for line in f:
-            count=0
-            l= line.replace(" \n","").split(" ")
-            if len(l)>1:
-                tb.append(l)
-        results['tb']['mem_data']=tb
+        results=self.readResults("simulation_results.bin","simulation_results_tb.bin")
 
         # Go back to main directory
         os.chdir(current_folder)
 
         return results
 
+    # Number of 32-bit words used to write a value with a given number of bits to the simulation results
+    def wordsPerValue(self,bits):
+        return 2 if bits=='DATA_WIDTH' and self.DATA_WIDTH>32 else 1
+
+    # Layout of the records written by the testbench: the cycle followed by every probed output, as unsigned 32-bit words
+    # Modelsim writes words with the byte order of the host, which is little-endian in the container
+    def resultsLayout(self):
+        fields=[('cycles','<u4')]
+        for mod, var_names in self.tb_var_names.items():
+            for var_name, elements, bits in var_names:
+                elements=self.N if elements=='N' else int(elements)
+                fields.append((mod+'.'+var_name,'<u4',(elements,self.wordsPerValue(bits))))
+        return np.dtype(fields)
+
+    # Read the records written by the testbench into one array per probed output (with one row per record) and the trace buffer into a TB_SIZExN array
+    # Values that were not initialized (x) are read as 0
+    def readResults(self,results_file,tb_file):
+        def join(words):
+            if words.shape[-1]==1:
+                return words[...,0]
+            return words[...,0].astype(np.uint64) | (words[...,1].astype(np.uint64) << np.uint64(32))
+        records=np.fromfile(results_file,dtype=self.resultsLayout())
+        results={'cycles':records['cycles'].astype(np.int64)}
+        for mod, var_names in self.tb_var_names.items():
+            results[mod]={}
+            for var_name, elements, bits in var_names:
+                values=join(records[mod+'.'+var_name])
+                results[mod][var_name]=values[:,0] if elements==1 else values
+        words=np.fromfile(tb_file,dtype='<u4').reshape(self.TB_SIZE,self.N,self.wordsPerValue('DATA_WIDTH'))
+        results.setdefault('tb',{})['mem_data']=join(words)
+        return results
+
+    # Append the words pushed by the data packer to a traceArchive, using the cycle of the simulation in which they were pushed
+    # The chain and eof flags of each word come from the block feeding the data packer, one cycle before the word is pushed
+    def archiveResults(self,results,archive):
+        blocks={'FilterReduceUnit':'fru','VectorVectorALU':'vvalu','VectorScalarReduce':'vsru'}
+        prev_name=blocks.get(self.BUILDING_BLOCKS[-3],'ib')
+        needed=[(prev_name,'valid_out'),(prev_name,'eof_out'),(prev_name,'chainId_out'),('dp','valid_out'),('dp','vector_out')]
+        assert all(var_name in results.get(mod,{}) for mod, var_name in needed) and np.array_equal(results['cycles'],np.arange(len(results['cycles']))), \
+            f"Archiving needs {', '.join(mod+'.'+var_name for mod, var_name in needed)} to be probed on every cycle"
+        prev=results[prev_name]
+        valid, eof, chain = (prev[var_name].astype(np.int64) for var_name in ['valid_out','eof_out','chainId_out'])
+
+        # A vector leaves its epoch once its last chain has gone through
+        last_chain = self.firmware['valid_chains'] if self.firmware is not None else 0
+        leaving = (valid==1) & (chain==last_chain) & (last_chain>0)
+        flags = np.stack((leaving & (eof&1>0),leaving & (eof&2>0)),axis=1)
+        epochs = np.cumsum(flags,axis=0)-flags
+
+        # Words are pushed one cycle after the data packer receives the value that completes them
+        cycles = np.flatnonzero(results['dp']['valid_out']==1)
+        cycles = cycles[cycles>0]
+        words = results['dp']['vector_out'][cycles].astype(np.uint64).reshape(-1,self.N)
+        keys = np.column_stack((epochs[cycles-1],chain[cycles-1]))
+        archive.append(archive.length,cycles,words,keys)
+
     def initialize_fu(vals):
         # Check if the values received have the correct size
         assert len(vals)==self.FUVRF_SIZE*M, "FU Initialization failed"
@@ -996,7 +1163,8 @@ class rtlHw():
         self.testbench_inputs=[]    # Stores inputs to testbench
         self.steps=0 # Number of steps for testbench 
         self.tb_var_names = None
-        self.compiler = compiler(N,M,MAX_CHAINS)
+        self.probes=struct(signals=None,window=None,trigger=None)
+        self.compiler = compiler(N,M,MAX_CHAINS,FUVRF_SIZE,VVVRF_SIZE)
         self.firmware = None
         self.top=self.rtlLogicInit()
         
\ No newline at end of file
@@ -1,6 +1,12 @@
 from copy import deepcopy as copy
+from collections import OrderedDict
+import os, bisect
+import numpy as np
 import yaml
 
+# Number of values converted at once by encode and decode, which limits the memory used by temporary arrays
+CHUNK_SIZE=1<<20
+
 ''' C-like struct '''
 class struct:
     def __init__(self, **kwds):
@@ -8,38 +14,221 @@ class struct:
     def __repr__(self):
         return str(self.__dict__)
 
+''' Dictionary that keeps at most maxsize entries, evicting the least recently used one '''
+class lruCache(OrderedDict):
+    def __init__(self,maxsize):
+        super().__init__()
+        self.maxsize=maxsize
+
+    def __getitem__(self,key):
+        value=super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self,key,value):
+        super().__setitem__(key,value)
+        self.move_to_end(key)
+        if len(self)>self.maxsize:
+            self.popitem(last=False)
+
 ''' Map list to int '''
 def toInt(lst):
     return [list(map(int, l)) for l in lst]
 
 ''' Encode vector of floats to ints '''
-def floatToEncodedInt(float_array,DATA_WIDTH):
-    return [encode(x,DATA_WIDTH) for x in float_array]
+def floatToEncodedInt(float_array,DATA_WIDTH,out=None):
+    return encode(float_array,DATA_WIDTH,out)
 
-''' Encode vector of floats to ints '''    
-def encode(value,DATA_WIDTH):
+''' Encode floats to ints (value may be a scalar or an array of any shape) '''    
+def encode(value,DATA_WIDTH,out=None):
+    assert DATA_WIDTH<=64, "Values can only be encoded with up to 64 bits"
     int_bits=int(DATA_WIDTH/2)
     frac_bits=int(DATA_WIDTH/2)
-    is_negative = value<0
     max_value = (1<<(int_bits-1+frac_bits))-1
-    x = round(value * (1<< frac_bits))
-    x = int(max_value if x > max_value else -max_value if x< -max_value else x)
-    if is_negative:
-        x = (1<<DATA_WIDTH) + x
-    return x
+    values = np.asarray(value,dtype=float)
+    words = np.empty(values.shape,dtype=np.uint64) if out is None else out
+    src, dst = values.reshape(-1), words.reshape(-1)
+    assert np.may_share_memory(dst,words) or dst.size==0, "out must be contiguous"
+    for begin in range(0,src.size,CHUNK_SIZE):
+        v = src[begin:begin+CHUNK_SIZE]
+        x = np.round(v * (1<<frac_bits))
+        # Rounded values are integers, so they exceed max_value if they reach max_value+1 (which is exact as a float)
+        high, low = x>=max_value+1, x<=-max_value-1
+        x[high|low] = 0
+        x = x.astype(np.int64)
+        x[high], x[low] = max_value, -max_value
+        # Negative values are stored in two's complement (uint64 arithmetic wraps around at 64 bits)
+        x = x.astype(np.uint64)
+        x[v<0] += np.uint64((1<<DATA_WIDTH) & ((1<<64)-1))
+        dst[begin:begin+CHUNK_SIZE] = x
+    return int(words) if values.ndim==0 else words
 
 ''' Decode vector of floats from encoded ints back to floats '''
-def encodedIntTofloat(encoded_int,DATA_WIDTH):
-    frac_bits=int(DATA_WIDTH/2)
-    return [[decode(encoded_value,DATA_WIDTH) for encoded_value in l] for l in encoded_int] 
+def encodedIntTofloat(encoded_int,DATA_WIDTH,out=None):
+    return decode(encoded_int,DATA_WIDTH,out)
 
-''' Decode vector of floats from encoded ints back to floats '''
-def decode(value,DATA_WIDTH):
+''' Decode floats from encoded ints (value may be a scalar or an array of any shape)
+    out may share memory with value (e.g. value.view(np.float64) to decode a 64-bit dump in place) '''
+def decode(value,DATA_WIDTH,out=None):
+    assert DATA_WIDTH<=64, "Values can only be decoded with up to 64 bits"
     int_bits=int(DATA_WIDTH/2)
     frac_bits=int(DATA_WIDTH/2)
-    value=float(value)
     max_value = (1<<(int_bits-1+frac_bits))-1
-    is_negative = value>max_value
-    if is_negative:
-        value = -((1<<DATA_WIDTH) - value)
-    return value / (1 << frac_bits)
\ No newline at end of file
+    words = np.asarray(value)
+    # Values read from simulation results are strings
+    if words.dtype.kind not in 'iu':
+        words = words.astype(np.uint64)
+    values = np.empty(words.shape,dtype=float) if out is None else out
+    src, dst = words.reshape(-1), values.reshape(-1)
+    assert np.may_share_memory(dst,values) or dst.size==0, "out must be contiguous"
+    for begin in range(0,src.size,CHUNK_SIZE):
+        # Each chunk is copied before being written, so that out can overlap with value
+        x = src[begin:begin+CHUNK_SIZE].astype(np.int64)
+        if DATA_WIDTH<64:
+            # 1<<DATA_WIDTH may not fit in 64 bits, so it is subtracted in two halves
+            negative = x>max_value
+            x[negative] -= 1<<(DATA_WIDTH-1)
+            x[negative] -= 1<<(DATA_WIDTH-1)
+        dst[begin:begin+CHUNK_SIZE] = x / (1 << frac_bits)
+    return float(values) if values.ndim==0 else values
+
+''' Pack pairs of DATA_WIDTH/2-bit values (along the last axis) into DATA_WIDTH-bit words
+    The first value of each pair goes into the lower half of the word '''
+def packHalf(halves,DATA_WIDTH):
+    halves = np.asarray(halves).astype(np.uint64)
+    assert halves.shape[-1]%2==0, "Half precision values must be packed in pairs"
+    return halves[...,0::2] | (halves[...,1::2] << np.uint64(DATA_WIDTH//2))
+
+''' Unpack DATA_WIDTH-bit words (along the last axis) into pairs of DATA_WIDTH/2-bit values
+    Fixed-point values can then be decoded with decode(halves,DATA_WIDTH/2) '''
+def unpackHalf(words,DATA_WIDTH):
+    words = np.asarray(words).astype(np.uint64)
+    mask = np.uint64((1<<(DATA_WIDTH//2))-1)
+    halves = np.empty(words.shape[:-1]+(2*words.shape[-1],),dtype=np.uint64)
+    halves[...,0::2] = words & mask
+    halves[...,1::2] = (words >> np.uint64(DATA_WIDTH//2)) & mask
+    return halves
+
+''' Format rows of DATA_WIDTH-bit words as text for $readmemh: one line per row, with words as fixed-width hex separated by spaces
+    Negative values are written in two's complement '''
+def toHex(rows,DATA_WIDTH):
+    rows = np.atleast_2d(rows)
+    digits = -(-DATA_WIDTH//4)
+    mask = np.uint64((1<<DATA_WIDTH)-1) if DATA_WIDTH<64 else np.uint64((1<<64)-1)
+    shifts = np.arange(4*(digits-1),-1,-4,dtype=np.uint64)
+    hex_digits = np.frombuffer(b'0123456789abcdef',dtype=np.uint8)
+    lines = []
+    # Rows are converted a chunk at a time, so temporary arrays are never much larger than the text itself
+    step = max(1,CHUNK_SIZE//max(1,rows.shape[1]))
+    for begin in range(0,len(rows),step):
+        words = rows[begin:begin+step]
+        words = (words if words.dtype.kind=='u' else words.astype(np.int64)).astype(np.uint64) & mask
+        text = np.empty(words.shape+(digits+1,),dtype=np.uint8)
+        text[...,:digits] = hex_digits[(words[...,None] >> shifts) & np.uint64(15)]
+        text[...,digits] = ord(' ')
+        text[:,-1,digits] = ord('\n')
+        lines.append(text.tobytes())
+    return b''.join(lines)
+
+''' Record of a word committed to the trace buffer: its sequence number, the cycle it was committed on and its N values '''
+def traceRecord(N,dtype=float):
+    return np.dtype([('seq',np.uint64),('cycle',np.uint64),('word',dtype,(N,))])
+
+# Entry of the index of a trace archive: words from "begin" on belong to a given eof[0] epoch, eof[1] epoch and chain
+ARCHIVE_INDEX=np.dtype([('epoch1',np.uint64),('epoch2',np.uint64),('chain',np.uint64),('begin',np.uint64)])
+
+''' Append-only archive of trace buffer words
+    Words are appended as traceRecord records to <path>.dat, which is read with np.memmap
+    <path>.idx gets one entry every time the epoch or the chain of the words changes, so the words of an epoch are found without reading the data '''
+class traceArchive():
+    def __init__(self,path,N,dtype=float):
+        self.path=path
+        self.record=traceRecord(N,dtype)
+        # Opening an existing archive appends to it
+        self.data=open(path+'.dat','ab')
+        self.index=open(path+'.idx','ab')
+        self.length=self.data.tell()//self.record.itemsize
+        entries=self.readIndex()
+        self.key=tuple(int(k) for k in entries[-1])[:3] if len(entries)>0 else None
+        # Epochs only go down if several runs are appended to the same archive. Otherwise, epochs are found with a binary search
+        self.monotonic=bool(np.all(entries['epoch1'][1:]>=entries['epoch1'][:-1]))
+
+    # Append K words with consecutive sequence numbers starting at seq
+    # Each word has its own cycle and (epoch1,epoch2,chain) key
+    def append(self,seq,cycles,words,keys):
+        K=len(words)
+        if K==0:
+            return
+        records=np.empty(K,dtype=self.record)
+        records['seq']=seq+np.arange(K)
+        records['cycle']=cycles
+        records['word']=words
+        self.data.write(records.tobytes())
+
+        # Words only get an index entry when their key differs from the one of the previous word
+        keys=np.asarray(keys,dtype=np.uint64).reshape(K,3)
+        changed=np.ones(K,dtype=bool)
+        changed[1:]=np.any(keys[1:]!=keys[:-1],axis=1)
+        if self.key is not None:
+            changed[0]=tuple(int(k) for k in keys[0])!=self.key
+        idx=np.flatnonzero(changed)
+        entries=np.empty(len(idx),dtype=ARCHIVE_INDEX)
+        entries['epoch1'], entries['epoch2'], entries['chain'] = keys[idx].T
+        entries['begin']=self.length+idx
+        self.index.write(entries.tobytes())
+        epochs=np.concatenate(([self.key[0]] if self.key is not None else [],entries['epoch1'])).astype(np.uint64)
+        self.monotonic=self.monotonic and bool(np.all(epochs[1:]>=epochs[:-1]))
+        self.key=tuple(int(k) for k in keys[-1])
+        self.length+=K
+
+    def flush(self):
+        self.data.flush()
+        self.index.flush()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+    def readIndex(self):
+        self.index.flush()
+        if os.path.getsize(self.path+'.idx')==0:
+            return np.zeros(0,dtype=ARCHIVE_INDEX)
+        return np.memmap(self.path+'.idx',dtype=ARCHIVE_INDEX,mode='r')
+
+    # All records of the archive, mapped from disk
+    def records(self):
+        self.flush()
+        if self.length==0:
+            return np.zeros(0,dtype=self.record)
+        return np.memmap(self.path+'.dat',dtype=self.record,mode='r',shape=(self.length,))
+
+    # Records of a given epoch (and chain). Epochs are counted from 0 and a word belongs to the epoch of the vector that completed it
+    # If epoch2 or chain are None, records of all eof[1] epochs or chains are returned
+    def epoch(self,epoch1,epoch2=None,chain=None):
+        entries=self.readIndex()
+        if self.monotonic:
+            first=bisect.bisect_left(entries['epoch1'],epoch1)
+            idx=np.arange(first,bisect.bisect_right(entries['epoch1'],epoch1,lo=first))
+        else:
+            idx=np.flatnonzero(entries['epoch1']==epoch1)
+
+        # Each index entry covers the records up to the next entry
+        selected=entries[idx]
+        begins=selected['begin'].astype(np.int64)
+        ends=np.where(idx+1<len(entries),entries['begin'][np.minimum(idx+1,len(entries)-1)].astype(np.int64),self.length)
+        keep=np.ones(len(idx),dtype=bool)
+        if epoch2 is not None:
+            keep&=selected['epoch2']==epoch2
+        if chain is not None:
+            keep&=selected['chain']==chain
+        begins, ends = begins[keep], ends[keep]
+        if len(begins)==0:
+            return np.zeros(0,dtype=self.record)
+
+        # Consecutive entries are read as a single range
+        split=np.flatnonzero(begins[1:]!=ends[:-1])+1
+        starts, stops = begins[np.append(0,split)], ends[np.append(split-1,len(ends)-1)]
+        records=self.records()
+        if len(starts)==1:
+            return records[starts[0]:stops[0]]
+        return np.concatenate([records[b:e] for b, e in zip(starts,stops)])